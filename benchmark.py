@@ -0,0 +1,273 @@
+"""Benchmark the bot against fake_bot_api.py, without a token or live Telegram
+
+Replays a synthetic update stream through handle_message, with auto-replies,
+photo downloads and history saving running as they do in production, then
+times redraws of the main and chat screens. Reports updates/sec, p50/p99
+handler and reply latency, memory growth and redraw cost, and saves them as
+JSON. Compare a run with an earlier one to catch regressions:
+
+    python benchmark.py --updates 5000 --output before.json
+    python benchmark.py --updates 5000 --baseline before.json
+
+Runs in a temporary directory, so the real chat history is never touched.
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from fake_bot_api import FakeBotAPI, synthetic_updates
+
+# Results where a bigger number is better; for every other result smaller is better
+HIGHER_IS_BETTER = {'updates_per_second'}
+BENCHMARK_TOKEN = "123456:benchmark"  # The fake API accepts any token
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the bot against a fake Bot API")
+    parser.add_argument('--updates', type=int, default=2000, help="updates replayed")
+    parser.add_argument('--chats', type=int, default=100, help="chats the updates come from")
+    parser.add_argument('--photo-ratio', type=float, default=0.05, help="share of updates carrying a photo")
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help="updates handled at once (1 matches the bot's default)")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds the fake API adds to every call")
+    parser.add_argument('--jitter', type=float, default=0.0, help="random +/- seconds around the latency")
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="share of sends answered with 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after sent with a 429")
+    parser.add_argument('--flood-limits', action='store_true',
+                        help="keep the bot's own outbound rate limits (off by default, as they cap "
+                             "throughput at API_GLOBAL_RATE replies per second)")
+    parser.add_argument('--redraws', type=int, default=200, help="redraws timed per screen")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default="benchmark_results.json", help="where to save the results")
+    parser.add_argument('--baseline', help="earlier results to compare against")
+    parser.add_argument('--tolerance', type=float, default=10,
+                        help="percent a result may worsen against the baseline before failing")
+    return parser.parse_args()
+
+def percentile(values, q):
+    """Return the q-th percentile (0-100) of values, nearest rank"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+def rss_kb():
+    """Return the resident memory of this process in KB"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError, AttributeError):
+        import resource  # Peak rather than current memory, the best there is off Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+class TerminalSink:
+    """Stands in for a terminal so the renderer takes its ANSI redraw path"""
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, text):
+        self.written += len(text.encode())
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return True
+
+# (start time, reply latency list) of the update being handled; the auto-reply
+# tasks handle_message starts inherit it
+update_started = contextvars.ContextVar('update_started')
+
+def time_auto_replies(bot):
+    """Make send_auto_reply record how long after its update it finished"""
+    send_auto_reply = bot.send_auto_reply
+
+    async def timed(*args):
+        started, reply = update_started.get()
+        await send_auto_reply(*args)
+        reply.append(time.perf_counter() - started)
+    
+    bot.send_auto_reply = timed
+
+async def replay(bot, app, fake, updates, concurrency):
+    """Hand updates to handle_message and return handler and reply latencies
+
+    Reply latencies are filled in as the auto-reply tasks finish.
+    """
+    from telegram import Update
+    from telegram.ext import CallbackContext
+
+    handler, reply = [], []
+    slots = asyncio.Semaphore(concurrency)
+
+    async def handle(data):
+        async with slots:
+            update = Update.de_json(fake.deliver(data), app.bot)
+            started = time.perf_counter()
+            update_started.set((started, reply))
+            await bot.handle_message(update, CallbackContext.from_update(update, app))
+            elapsed = time.perf_counter() - started
+        handler.append(elapsed)
+
+    await asyncio.gather(*(handle(data) for data in updates))
+    return handler, reply
+
+async def run_updates(bot, instance, fake, args):
+    app = instance.app
+    time_auto_replies(bot)
+    warmup = synthetic_updates(min(100, args.updates), args.chats, args.photo_ratio, seed=args.seed + 1,
+                               first_id=10 ** 9)
+    updates = synthetic_updates(args.updates, args.chats, args.photo_ratio, seed=args.seed)
+
+    async with app:
+        await app.start()
+        await replay(bot, app, fake, warmup, args.concurrency)
+
+        rss_before = rss_kb()
+        started = time.perf_counter()
+        handler, reply = await replay(bot, app, fake, updates, args.concurrency)
+        await app.stop()  # Waits for the photo downloads and replies handle_message started
+        elapsed = time.perf_counter() - started
+        rss_after = rss_kb()
+    await bot.api_pool.aclose()
+
+    return {
+        'updates_per_second': args.updates / elapsed,
+        'handler_p50_ms': percentile(handler, 50) * 1000,
+        'handler_p99_ms': percentile(handler, 99) * 1000,
+        'reply_p50_ms': percentile(reply, 50) * 1000,
+        'reply_p99_ms': percentile(reply, 99) * 1000,
+        'rss_growth_kb': rss_after - rss_before,
+        'rss_growth_bytes_per_update': (rss_after - rss_before) * 1024 / args.updates,
+    }
+
+def time_redraws(bot, instance, draw, chat_id, count, full):
+    """Return (ms, bytes) per redraw of a screen, drawn from scratch or as a diff"""
+    sink = TerminalSink()
+    bot.screen = bot.ScreenRenderer(sink)
+    # Screens print(), which the renderer captures while it stands in for stdout
+    stdout, sys.stdout = sys.stdout, bot.screen
+    try:
+        draw()
+        sink.written = 0
+        elapsed = 0.0
+        for n in range(count):
+            # A new message between redraws, as when the display thread wakes up
+            bot.record_message(instance, chat_id, bot.Message(2 * 10 ** 9 + n, bot.Direction.INCOMING,
+                                                              bot.MessageType.TEXT, text=f"redraw {n}"))
+            if full:
+                bot.screen.clear()
+            started = time.perf_counter()
+            draw()
+            elapsed += time.perf_counter() - started
+    finally:
+        sys.stdout = stdout
+    return elapsed * 1000 / count, sink.written / count
+
+def run_redraws(bot, instance, args):
+    # A fixed terminal size keeps redraw results comparable between machines
+    os.environ['COLUMNS'], os.environ['LINES'] = "120", "60"
+    chats = instance.active_chats
+    busiest = max(chats.keys(), key=lambda chat_id: len(chats[chat_id]['messages']))
+    bot.current_display = busiest
+    results = {}
+    for name, draw in (('main', bot.display_main_interface),
+                       ('chat', lambda: bot.display_chat_interface(busiest))):
+        for mode, full in (('full', True), ('diff', False)):
+            ms, size = time_redraws(bot, instance, draw, busiest, args.redraws, full)
+            results[f'redraw_{name}_{mode}_ms'] = ms
+            results[f'redraw_{name}_{mode}_bytes'] = size
+    return results
+
+def compare(results, baseline, tolerance):
+    """Print each result against the baseline and return the names that regressed"""
+    regressed = []
+    print(f"\n{'Result':<34}{'Baseline':>12}{'Now':>12}{'Change':>9}")
+    print("─" * 67)
+    for name, value in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        change = (value - before) * 100 / before
+        worse = -change if name in HIGHER_IS_BETTER else change
+        flag = ""
+        if worse > tolerance:
+            regressed.append(name)
+            flag = "  REGRESSED"
+        print(f"{name:<34}{before:>12.2f}{value:>12.2f}{change:>+8.1f}%{flag}")
+    return regressed
+
+def main():
+    args = parse_args()
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    fake = FakeBotAPI(port=0, latency=args.latency, jitter=args.jitter, flood_rate=args.flood_rate,
+                      retry_after=args.retry_after, seed=args.seed).start()
+
+    # main reads the API URL and its files relative to the working directory on import
+    os.environ['TELEGRAM_API_URL'] = fake.url
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    workdir = tempfile.mkdtemp(prefix="bot-benchmark-")
+    os.chdir(workdir)
+    import main as bot
+
+    if not args.flood_limits:
+        bot.API_GLOBAL_RATE = bot.API_CHAT_RATE = bot.API_GROUP_RATE = bot.API_CHAT_BURST = 10 ** 9
+    instance = bot.BotInstance("benchmark", BENCHMARK_TOKEN)
+    instance.app = bot.build_application(instance)
+    instance.auto_replies.rate_limit = 0
+    bot.bots[instance.name] = bot.current_bot = instance
+    bot.headless = True  # Redraws are timed on their own below
+    os.makedirs(bot.IMAGES_DIR, exist_ok=True)
+
+    print(f"Replaying {args.updates} updates from {args.chats} chats against {fake.url}...")
+    results = asyncio.run(run_updates(bot, instance, fake, args))
+    instance.history_store.flush()
+    results.update(run_redraws(bot, instance, args))
+    instance.history_store.close()
+    fake.close()
+
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'params': {key: value for key, value in vars(args).items()
+                   if key not in ('output', 'baseline', 'tolerance')},
+        'results': results,
+        'fake_api': fake.stats(),
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for name, value in results.items():
+        print(f"{name:<34}{value:>12.2f}")
+    print(f"\nResults saved to {output}")
+
+    if baseline is not None:
+        regressed = compare(results, baseline, args.tolerance)
+        if regressed:
+            print(f"\n{len(regressed)} results worse than the baseline by more than {args.tolerance}%")
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+"""Local stand-in for the Telegram Bot API, for load tests and benchmarks
+
+Answers getMe, getUpdates, sendMessage, sendPhoto, deleteMessage and getFile
+(plus the webhook calls polling makes on startup) for any token, and serves
+the files getFile points at. Every call can be slowed down by a fixed
+latency with random jitter, and a share of sends can be answered with 429
+Too Many Requests to exercise the bot's retry path.
+
+Point the bot at it with TELEGRAM_API_URL:
+
+    python fake_bot_api.py --port 8088 --updates 1000 --latency 0.05 --flood-rate 0.01
+    TELEGRAM_API_URL=http://127.0.0.1:8088 python main.py
+
+GET /_stats returns the calls served so far.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+FLOODED_METHODS = ('sendMessage', 'sendPhoto', 'deleteMessage')  # Methods 429s are injected into
+MAX_POLL_TIMEOUT = 5  # Longest a getUpdates long poll is held open, in seconds
+SYNTHETIC_TEXTS = ("hi", "hello there", "how are you", "what time is it?", "thanks!", "see you tomorrow")
+
+def synthetic_updates(count, chats=100, photo_ratio=0.0, photos=20, seed=0, first_id=1):
+    """Return count Bot API updates from chats private chats, as JSON dicts
+
+    Texts cycle through a few that do and do not trigger the default
+    auto-replies. photo_ratio of the messages carry one of photos distinct
+    photos instead, so repeated photos can be deduplicated. The same seed
+    gives the same stream. FakeBotAPI renumbers the messages as it delivers
+    them, see FakeBotAPI.deliver().
+    """
+    rng = random.Random(seed)
+    updates = []
+    for n in range(first_id, first_id + count):
+        chat_id = 1000 + rng.randrange(chats)
+        name = {'first_name': f"User {chat_id}", 'username': f"user{chat_id}"}
+        message = {'message_id': n, 'date': int(time.time()),
+                   'from': dict(name, id=chat_id, is_bot=False),
+                   'chat': dict(name, id=chat_id, type='private')}
+        if rng.random() < photo_ratio:
+            photo = rng.randrange(photos)
+            message['photo'] = [{'file_id': f"photo-{photo}", 'file_unique_id': f"unique-{photo}",
+                                 'width': 1280, 'height': 960}]
+        else:
+            message['text'] = rng.choice(SYNTHETIC_TEXTS)
+        updates.append({'update_id': n, 'message': message})
+    return updates
+
+class FakeBotAPI:
+    """Threaded HTTP server imitating the Bot API
+
+    latency is the mean delay added to every call, jitter the +/- range
+    around it. flood_rate is the chance a call to one of FLOODED_METHODS is
+    refused with 429 and retry_after.
+    """
+
+    def __init__(self, host="127.0.0.1", port=8088, latency=0.0, jitter=0.0, flood_rate=0.0,
+                 retry_after=1, file_size=64 * 1024, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.file_size = file_size
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._updates_ready = threading.Condition(self._lock)
+        self._updates = []  # Not yet confirmed by a getUpdates offset
+        self._numbered = set()  # update_ids of the updates given a message_id by getUpdates
+        self._next_message_id = 1  # Shared by delivered updates and sent messages
+        self.calls = {}  # method -> calls answered
+        self.flooded = 0  # 429s served
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-alive, like the real API
+            # Headers and body go out in separate writes; with Nagle's algorithm
+            # the body waits out the client's delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                fake._handle(self)
+
+            def do_POST(self):
+                fake._handle(self)
+
+            def log_message(self, format, *args):
+                pass  # Thousands of requests would drown the output
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address[:2]
+        self.url = f"http://{self.host}:{self.port}"
+
+    def start(self):
+        """Serve from a background thread and return self"""
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_updates(self, updates):
+        """Queue updates for getUpdates to hand out"""
+        with self._updates_ready:
+            self._updates.extend(updates)
+            self._updates_ready.notify_all()
+
+    def deliver(self, update):
+        """Give an update's message the next message_id and return the update
+
+        Telegram numbers a chat's incoming and sent messages in one sequence,
+        so a reply gets a higher id than the message it answers and a lower
+        one than the next. getUpdates does this for the updates it hands out;
+        call it for updates passed to the bot some other way.
+        """
+        with self._lock:
+            self._number(update)
+        return update
+
+    def _number(self, update):
+        update['message']['message_id'] = self._next_message_id
+        self._next_message_id += 1
+
+    def stats(self):
+        with self._lock:
+            return {'calls': dict(self.calls), 'flooded': self.flooded,
+                    'updates_pending': len(self._updates)}
+
+    def _handle(self, request):
+        url = urlsplit(request.path)
+        body = request.rfile.read(int(request.headers.get('Content-Length', 0)))
+        if url.path == '/_stats':
+            return self._reply(request, 200, self.stats())
+        if url.path.startswith('/file/bot'):
+            return self._reply(request, 200, b"\0" * self.file_size, "image/jpeg")
+
+        match = re.fullmatch(r'/bot[^/]+/(\w+)', url.path)
+        if not match:
+            return self._reply(request, 404, {'ok': False, 'error_code': 404, 'description': "Not Found"})
+        method = match.group(1)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        params.update(self._parse_body(request.headers.get('Content-Type', ''), body))
+
+        delay = self.latency + self._rng.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            flooded = method in FLOODED_METHODS and self._rng.random() < self.flood_rate
+            if flooded:
+                self.flooded += 1
+        if flooded:
+            return self._reply(request, 429, {
+                'ok': False, 'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after}})
+
+        handler = getattr(self, f"_api_{method}", None)
+        if handler is None:
+            # Webhook housekeeping and anything else the bot does not depend on
+            return self._reply(request, 200, {'ok': True, 'result': True})
+        return self._reply(request, 200, {'ok': True, 'result': handler(params)})
+
+    @staticmethod
+    def _parse_body(content_type, body):
+        """Return the fields of a JSON, form-encoded or multipart body, ignoring file parts"""
+        if not body:
+            return {}
+        if content_type.startswith('application/json'):
+            return json.loads(body)
+        if content_type.startswith('multipart/form-data'):
+            fields = {}
+            for name, value in re.findall(rb'name="([^"]+)"\r\n\r\n(.*?)\r\n--', body, re.S):
+                fields[name.decode()] = value.decode('utf-8', 'replace')
+            return fields
+        return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+    @staticmethod
+    def _reply(request, status, payload, content_type="application/json"):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def _message(self, params, **fields):
+        with self._lock:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+        chat_id = int(params.get('chat_id', 0))
+        return dict({'message_id': message_id, 'date': int(time.time()),
+                     'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'}}, **fields)
+
+    def _api_getMe(self, params):
+        return {'id': 1, 'is_bot': True, 'first_name': "Fake Bot", 'username': "fake_bot",
+                'can_join_groups': True, 'can_read_all_group_messages': False,
+                'supports_inline_queries': False}
+
+    def _api_getUpdates(self, params):
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 100))
+        deadline = time.monotonic() + min(float(params.get('timeout', 0)), MAX_POLL_TIMEOUT)
+        with self._updates_ready:
+            # Updates below the offset have been confirmed and are dropped for good
+            self._numbered.difference_update(update['update_id'] for update in self._updates
+                                             if update['update_id'] < offset)
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._updates_ready.wait(deadline - time.monotonic())
+            for update in self._updates[:limit]:
+                if update['update_id'] not in self._numbered:  # Handed out again until confirmed
+                    self._numbered.add(update['update_id'])
+                    self._number(update)
+            return self._updates[:limit]
+
+    def _api_sendMessage(self, params):
+        return self._message(params, text=params.get('text', ""))
+
+    def _api_sendPhoto(self, params):
+        message = self._message(params, caption=params.get('caption', ""))
+        file_id = self._sent_file_id(params, 'photo', message)
+        message['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1280, 'height': 960}]
+        return message
+
+    def _api_sendDocument(self, params):
+        return self._send_file(params, 'document')
+
+    def _api_sendVideo(self, params):
+        return self._send_file(params, 'video', width=1280, height=720, duration=10)
+
+    def _api_sendVoice(self, params):
+        return self._send_file(params, 'voice', duration=5)
+
+    def _api_sendAudio(self, params):
+        return self._send_file(params, 'audio', duration=180)
+
+    def _api_sendSticker(self, params):
+        return self._send_file(params, 'sticker', width=512, height=512, is_animated=False, is_video=False)
+
+    def _send_file(self, params, attribute, **fields):
+        """Answer a send of a single-file attachment, which the message carries under attribute"""
+        message = self._message(params, caption=params.get('caption', ""))
+        file_id = self._sent_file_id(params, attribute, message)
+        message[attribute] = dict({'file_id': file_id, 'file_unique_id': file_id, 'file_size': self.file_size},
+                                  **fields)
+        return message
+
+    @staticmethod
+    def _sent_file_id(params, attribute, message):
+        # An uploaded file gets a new file_id, a resent one keeps its own
+        return params.get(attribute) or f"uploaded-{message['message_id']}"
+
+    def _api_deleteMessage(self, params):
+        return True
+
+    def _api_getFile(self, params):
+        file_id = params.get('file_id', "")
+        return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': self.file_size,
+                'file_path': f"photos/{file_id}.jpg"}
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake Telegram Bot API for load tests")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8088)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every call")
+    parser.add_argument('--jitter', type=float, default=0.0, help="random +/- seconds around the latency")
+    parser.add_argument('--flood-rate', type=float, default=0.0,
+                        help="share of sends and deletions answered with 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after sent with a 429")
+    parser.add_argument('--file-size', type=int, default=64 * 1024, help="bytes served per downloaded file")
+    parser.add_argument('--updates', type=int, default=0, help="synthetic updates queued for getUpdates")
+    parser.add_argument('--chats', type=int, default=100, help="chats the synthetic updates come from")
+    parser.add_argument('--photo-ratio', type=float, default=0.0, help="share of updates carrying a photo")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    fake = FakeBotAPI(args.host, args.port, args.latency, args.jitter, args.flood_rate,
+                      args.retry_after, args.file_size, args.seed)
+    fake.add_updates(synthetic_updates(args.updates, args.chats, args.photo_ratio, seed=args.seed))
+    print(f"Fake Bot API listening on {fake.url}, {args.updates} updates queued")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        print("Goodbye!")
+    finally:
+        fake.server.server_close()
+
+if __name__ == "__main__":
+    main()
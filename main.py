@@ -1,34 +1,1566 @@
 import threading
 import time
 import os
+import asyncio
 import requests
-from io import BytesIO
+import httpx
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 from datetime import datetime
 from telegram import Update
 from telegram.ext import Application, MessageHandler, filters, ContextTypes
-from config import BOT_TOKEN
+import config
 import mimetypes
 import shutil
-import random
 import pickle
+import queue
+import sqlite3
+import heapq
+import itertools
+import bisect
+from collections import OrderedDict
+import re
+import enum
+import uuid
+import json
+import hmac
+import argparse
+import sys
+import contextlib
+import multiprocessing
+import signal
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Store chat data
-active_chats = {}
-message_queue = []
+bots = {}  # Bot name -> BotInstance, in config order, created in main()
+current_bot = None  # BotInstance the console is showing
+message_queue = queue.Queue()  # Notifications waiting for the display thread
 console_lock = threading.Lock()
 current_display = "main"  # Track what's currently displayed
 refresh_needed = False  # Flag to indicate if display needs refresh
-pending_deletions = []  # Track messages scheduled for deletion
-chat_history = {}  # Store complete chat history
+headless = False  # No terminal UI, see --headless
+control_server = None  # Headless control API, started with the bot
+metrics_server = None  # Prometheus metrics endpoint, started with the bot
+screen = None  # ScreenRenderer standing in for stdout, installed in main()
+shard_queues = []  # One queue per worker process with --workers, indexed by shard
+worker_shard = None  # (shard, worker count) inside a worker process
 
 # Global settings
+# Bots hosted by this process: config.BOT_TOKENS maps a name to each token,
+# a lone config.BOT_TOKEN runs a single bot called DEFAULT_BOT
+DEFAULT_BOT = "main"
+BOT_TOKENS = getattr(config, 'BOT_TOKENS', None) or {DEFAULT_BOT: config.BOT_TOKEN}
+
 message_timer = {'image': 0, 'text': 0}  # Default no timer
 auto_delete = False
 save_history = True  # Enable chat history saving
+live_window_size = 500  # Messages kept in memory per chat, older ones are read back from history
+
+# Auto-reply settings
+AUTO_REPLY_FILE = "auto_replies.json"  # Rules file, reloaded when it changes
+AUTO_REPLY_RELOAD_INTERVAL = 2  # Seconds between checks for a changed rules file
+DEFAULT_AUTO_REPLIES = {
+    'rate_limit_seconds': 10,
+    'rules': [
+        {'trigger': "hi", 'reply': "Hello! 👋"},
+        {'trigger': "hello", 'reply': "Hi there!"},
+        {'trigger': "how are you", 'reply': "I'm doing great, thanks for asking! How about you?"},
+        {'trigger': "bye", 'reply': "Goodbye! 👋"},
+        {'trigger': "thanks", 'reply': "You're welcome! 😊"}
+    ]
+}
+
+# Broadcasts
+BROADCAST_WORKERS = 16  # Chats sent to at the same time, keep at or below API_POOL_SIZE
+BROADCAST_FAILURES_SHOWN = 20  # Failed chats listed after a broadcast
+
+# Webhook mode (--webhook), for running behind a reverse proxy
+WEBHOOK_HOST = "127.0.0.1"  # Interface the webhook server listens on
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"  # Path Telegram (or the proxy) posts updates to
+HTTP_MAX_BODY = 1024 * 1024  # Largest request body the webhook and control servers accept
+
+# Headless mode (--headless) control API
+CONTROL_HOST = "127.0.0.1"  # Keep local, the control API has no authentication
+CONTROL_PORT = 8081
+
+# Worker processes (--workers), each handling the updates of a shard of chats
+WORKER_STOP_TIMEOUT = 30  # Seconds a worker gets to finish its queued updates on shutdown
+WORKER_METRICS_INTERVAL = 5  # Seconds between the metric snapshots a worker sends to the front process
+
+# Metrics endpoint, scraped by Prometheus (see also /stats)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464  # 0 turns the endpoint off
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Seconds
+
+# Media attachments, see MEDIA_TYPES
+IMAGES_DIR = "downloaded_images"  # Incoming photos
+MEDIA_DIR = "downloaded_media"  # Every other incoming attachment
+MAX_DOWNLOAD_SIZE = 20 * 1024 * 1024  # Largest file the Bot API lets a bot download
+MAX_UPLOAD_SIZE = 50 * 1024 * 1024  # Largest file a bot can upload
+MAX_PHOTO_UPLOAD_SIZE = 10 * 1024 * 1024  # Photos have a lower upload limit
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # Bytes written to disk per download chunk
+DOWNLOAD_CONCURRENCY = 4  # Attachments downloaded at the same time
+download_slots = None  # asyncio.Semaphore, created on the bot's event loop
+downloads_in_flight = {}  # file_unique_id -> task downloading that file
+
+# Message views show one page at a time, newest page first
+PAGE_SIZE = 20
+view_offsets = {}  # Screen (current_display value) -> messages scrolled back from newest
+SEARCH_LIMIT = 50  # Max results shown for /search
+last_search = ("", [])  # Query and results shown on the search screen
+CHAT_LIST_SIZE = 20  # Most recently active chats listed on the main and delete screens
+delete_filter = None  # Name prefix the delete screen is narrowed to, if any
+delete_choices = []  # Chat ids in the order the delete screen numbered them
+
+# Console rendering
+RENDER_MAX_FPS = 20  # Most redraws per second from incoming messages, faster updates are batched
+RENDER_SCROLL_MARGIN = 2  # Spare rows for typed input the renderer cannot see
+
+# Display queue statistics, see get_queue_stats()
+queue_stats = {'rendered': 0, 'total_latency': 0.0, 'last_latency': 0.0, 'max_latency': 0.0}
+
+class Direction(enum.IntEnum):
+    INCOMING = 0
+    OUTGOING = 1
+
+class MessageType(enum.IntEnum):
+    TEXT = 0
+    IMAGE = 1
+    DOCUMENT = 2
+    VIDEO = 3
+    VOICE = 4
+    AUDIO = 5
+    STICKER = 6
+
+class Message:
+    """A single chat message
+
+    Uses __slots__ and an epoch timestamp instead of a dict and a datetime,
+    since every chat keeps many of these in memory.
+    """
+
+    __slots__ = ('message_id', 'ts', 'direction', 'kind', 'text', 'filename', 'local_path', 'seen')
+
+    def __init__(self, message_id, direction, kind, ts=None, text=None,
+                 filename=None, local_path=None, seen=False):
+        self.message_id = message_id
+        self.ts = time.time() if ts is None else ts
+        self.direction = direction
+        self.kind = kind
+        self.text = text
+        self.filename = filename
+        self.local_path = local_path
+        self.seen = seen
+
+    @property
+    def time(self):
+        return datetime.fromtimestamp(self.ts)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a message from the dicts pickled by older versions"""
+        return cls(data.get('message_id'), Direction[data['direction'].upper()],
+                   MessageType[data['type'].upper()], ts=data['time'].timestamp(),
+                   text=data.get('text'), filename=data.get('filename'),
+                   local_path=data.get('local_path'), seen=data.get('seen', False))
+
+class MediaTooLarge(ValueError):
+    """An attachment is over its size limit for downloading"""
+
+MEDIA_TYPES = {}  # MessageType -> MediaType, in the order messages are checked for them
+MEDIA_COMMANDS = {}  # Console command, like "/image" -> MediaType
+
+class MediaType:
+    """One kind of attachment: how it is received, stored, sent and shown
+
+    Creating one registers it. The bot then accepts it (message_filter),
+    streams it into directory, sends it with /<command> on the console or
+    "<command>_path" in the control API, and shows it as [label: file].
+    attribute names both the Message field it arrives in and the field it
+    is uploaded as, and gives the send method, e.g. photo -> sendPhoto.
+    """
+
+    def __init__(self, kind, attribute, command, label, icon, message_filter, extension="",
+                 directory=MEDIA_DIR, max_download=MAX_DOWNLOAD_SIZE, max_upload=MAX_UPLOAD_SIZE,
+                 caption=None, preview=False):
+        self.kind = kind
+        self.attribute = attribute
+        self.command = command
+        self.label = label
+        self.icon = icon
+        self.message_filter = message_filter
+        self.extension = extension  # Used when the file's name and MIME type give none
+        self.directory = directory
+        self.max_download = max_download
+        self.max_upload = max_upload
+        self.caption = caption  # Sent with every upload, if set
+        self.preview = preview  # Opened in an image viewer when received
+        self.send_method = "send" + attribute.capitalize()
+        MEDIA_TYPES[kind] = self
+        MEDIA_COMMANDS["/" + command] = self
+
+    def attachment(self, message):
+        """Return the attachment of this type a Telegram message carries, or None"""
+        value = getattr(message, self.attribute, None)
+        if isinstance(value, (list, tuple)):
+            # Photos come in several sizes, largest last
+            value = value[-1] if value else None
+        return value
+
+    def sent_file_id(self, result):
+        """Return the file_id of an attachment in a Bot API send result, or None
+
+        Telegram may file an upload under another field, such as a GIF sent
+        as a document coming back as an animation.
+        """
+        value = result.get(self.attribute)
+        if isinstance(value, list):
+            value = value[-1] if value else None
+        return value.get('file_id') if isinstance(value, dict) else None
+
+    def file_extension(self, attachment):
+        name = getattr(attachment, 'file_name', None) or ""
+        extension = os.path.splitext(name)[1]
+        if not re.fullmatch(r'\.\w{1,10}', extension):
+            extension = mimetypes.guess_extension(getattr(attachment, 'mime_type', None) or "") or ""
+        return extension or self.extension
+
+    def filename(self, attachment):
+        """Return the local file name of an attachment; identical files share one"""
+        return f"{self.command}_{attachment.file_unique_id}{self.file_extension(attachment)}"
+
+class StickerType(MediaType):
+    """Stickers have no MIME type, animated and video ones are not WebP"""
+
+    def file_extension(self, attachment):
+        if getattr(attachment, 'is_video', False):
+            return ".webm"
+        if getattr(attachment, 'is_animated', False):
+            return ".tgs"
+        return self.extension
+
+MediaType(MessageType.IMAGE, 'photo', 'image', "Image", "📸", filters.PHOTO, ".jpg", directory=IMAGES_DIR,
+          max_upload=MAX_PHOTO_UPLOAD_SIZE, caption="📸 Photo", preview=True)
+MediaType(MessageType.DOCUMENT, 'document', 'document', "Document", "📄", filters.Document.ALL)
+MediaType(MessageType.VIDEO, 'video', 'video', "Video", "🎬", filters.VIDEO, ".mp4")
+MediaType(MessageType.VOICE, 'voice', 'voice', "Voice message", "🎤", filters.VOICE, ".ogg")
+MediaType(MessageType.AUDIO, 'audio', 'audio', "Audio", "🎵", filters.AUDIO, ".mp3")
+StickerType(MessageType.STICKER, 'sticker', 'sticker', "Sticker", "🏷️", filters.Sticker.ALL, ".webp")
+
+def media_of(message):
+    """Return the MediaType and attachment of a Telegram message, or (None, None) for text"""
+    for media in MEDIA_TYPES.values():
+        attachment = media.attachment(message)
+        if attachment is not None:
+            return media, attachment
+    return None, None
+
+def format_size(size):
+    """Return a byte count as KB or MB for messages"""
+    return f"{size / 2 ** 20:.1f} MB" if size >= 2 ** 20 else f"{size // 1024} KB"
+
+def message_content(msg):
+    """Return a message as shown on screen: its text, or a label for its attachment"""
+    media = MEDIA_TYPES.get(msg.kind)
+    if media is None:
+        return msg.text
+    label = f"[{media.label}: {msg.filename or media.attribute}] {media.icon}"
+    return f"{label} {msg.text}" if msg.text else label
+
+class ChatStore:
+    """Active chats, shared by the bot's event loop and the console and worker threads
+
+    Each chat is a dict with its own lock, which every method reading or
+    changing the chat's messages takes, so threads working on different
+    chats never wait on each other. The store lock only guards adding and
+    removing chats and the indexes. keys() and items() return snapshots, so
+    a renderer can walk the chats while messages keep arriving.
+    
+    Chats are also indexed by last activity, so recent() returns the K most
+    recently active chats in O(K), and by lowercased name and username, so
+    find() resolves a prefix with a binary search.
+    """
+
+    def __init__(self):
+        self._chats = {}
+        self._lock = threading.Lock()
+        self._recency = OrderedDict()  # chat_id -> None, least recently active first
+        self._names = []  # Sorted (lowercased name or username, chat_id) pairs
+
+    def __contains__(self, chat_id):
+        return chat_id in self._chats
+
+    def __getitem__(self, chat_id):
+        return self._chats[chat_id]
+
+    def __len__(self):
+        return len(self._chats)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, chat_id, default=None):
+        return self._chats.get(chat_id, default)
+
+    def keys(self):
+        with self._lock:
+            return list(self._chats)
+
+    def items(self):
+        with self._lock:
+            return list(self._chats.items())
+
+    def add_chat(self, chat_id, name, username):
+        """Return (chat, created), creating the chat if it is not known yet"""
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            if chat is not None:
+                return chat, False
+            chat = self._chats[chat_id] = {
+                'name': name,
+                'username': username,
+                'messages': {},  # message_id -> message, in arrival order
+                'unread': 0,  # Incoming messages newer than last_read_id
+                'last_read_id': 0,  # Newest message_id the user has seen in this chat
+                'seen_upto': 0,  # Outgoing messages before this message_id have been seen
+                'lock': threading.Lock()  # Guards this chat's messages and counters
+            }
+            self._recency[chat_id] = None
+            for key in self._name_keys(chat_id, chat):
+                bisect.insort(self._names, key)
+            return chat, True
+
+    def remove_chat(self, chat_id):
+        """Forget a chat, returning it or None"""
+        with self._lock:
+            chat = self._chats.pop(chat_id, None)
+            if chat is not None:
+                del self._recency[chat_id]
+                for key in self._name_keys(chat_id, chat):
+                    del self._names[bisect.bisect_left(self._names, key)]
+            return chat
+
+    @staticmethod
+    def _name_keys(chat_id, chat):
+        keys = {(chat['name'].lower(), chat_id)}
+        if chat['username']:
+            keys.add((chat['username'].lower(), chat_id))
+        return keys
+
+    def recent(self, limit=None):
+        """Return up to limit (chat_id, chat) pairs, most recently active first"""
+        with self._lock:
+            return [(chat_id, self._chats[chat_id])
+                    for chat_id in itertools.islice(reversed(self._recency), limit)]
+
+    def find(self, prefix, limit=None):
+        """Return (chat_id, chat) pairs whose name or @username starts with prefix"""
+        prefix = prefix.strip().lstrip('@').lower()
+        found = {}
+        with self._lock:
+            i = bisect.bisect_left(self._names, (prefix,))
+            while i < len(self._names) and self._names[i][0].startswith(prefix):
+                chat_id = self._names[i][1]
+                found.setdefault(chat_id, self._chats[chat_id])
+                if len(found) == limit:
+                    break
+                i += 1
+        return list(found.items())
+
+    def add_message(self, chat_id, msg, limit):
+        """Add a message, dropping the oldest beyond limit; incoming ones count as unread"""
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            return
+        with chat['lock']:
+            messages = chat['messages']
+            messages[msg.message_id] = msg
+            while len(messages) > limit:
+                del messages[next(iter(messages))]
+            if msg.direction == Direction.INCOMING:
+                chat['unread'] += 1
+        
+        with self._lock:
+            if chat_id in self._recency:
+                self._recency.move_to_end(chat_id)
+
+    def pop_message(self, chat_id, message_id=None, position=None):
+        """Remove a message by id or by position (oldest first), returning it or None"""
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            return None
+        with chat['lock']:
+            messages = chat['messages']
+            if position is not None:
+                if not 0 <= position < len(messages):
+                    return None
+                message_id = next(itertools.islice(messages, position, None))
+            msg = messages.pop(message_id, None)
+            if msg is not None and msg.direction == Direction.INCOMING and message_id > chat['last_read_id']:
+                chat['unread'] = max(0, chat['unread'] - 1)
+            return msg
+
+    def clear_messages(self, chat_id):
+        chat = self._chats[chat_id]
+        with chat['lock']:
+            chat['messages'].clear()
+            chat['unread'] = 0
+
+    def mark_read(self, chat_id):
+        """Move the chat's read watermark to its newest message"""
+        chat = self._chats[chat_id]
+        with chat['lock']:
+            if chat['messages']:
+                chat['last_read_id'] = next(reversed(chat['messages']))
+            chat['unread'] = 0
+
+    def mark_seen_upto(self, chat_id, message_id):
+        """Move the chat's seen watermark forward, returning True if it moved"""
+        chat = self._chats[chat_id]
+        with chat['lock']:
+            if message_id <= chat['seen_upto']:
+                return False
+            chat['seen_upto'] = message_id
+            return True
+
+    def page(self, chat_id, offset, size=PAGE_SIZE):
+        """Return (start, page) for one page of the chat's messages, see window_messages()"""
+        chat = self._chats[chat_id]
+        with chat['lock']:
+            # The chat may have shrunk since the caller clamped offset
+            offset = max(0, min(offset, len(chat['messages']) - size))
+            return window_messages(chat['messages'], offset, size)
+
+metrics_registry = []  # Every metric, in the order they are rendered
+worker_metrics = {}  # shard -> {metric name: snapshot()} last reported by each worker process
+
+class Metric:
+    """A named metric holding one series per combination of label values"""
+    
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._series = {}  # Label values tuple -> series state
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}" if pairs else ""
+
+    def snapshot(self):
+        """Return {label values: series} copied under the lock"""
+        with self._lock:
+            return {key: self._copy(series) for key, series in self._series.items()}
+
+    @staticmethod
+    def _copy(series):
+        return series
+
+    def merged(self):
+        """Return snapshot() with the series last reported by the worker processes added in"""
+        merged = self.snapshot()
+        for snapshots in list(worker_metrics.values()):
+            for key, series in snapshots.get(self.name, {}).items():
+                merged[key] = self._add(merged[key], series) if key in merged else series
+        return merged
+
+    @staticmethod
+    def _add(series, other):
+        return series + other
+
+    def render(self):
+        """Return the metric in the Prometheus text exposition format"""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+class Counter(Metric):
+    """Monotonic count, such as requests made or bytes downloaded"""
+    
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def total(self):
+        with self._lock:
+            return sum(self._series.values())
+
+    def _samples(self):
+        for key, value in sorted(self.merged().items()):
+            yield f"{self.name}{self._labels(key)} {value}"
+
+class Gauge(Metric):
+    """Current value read from func() whenever the metric is rendered"""
+    
+    kind = "gauge"
+
+    def __init__(self, name, help_text, func):
+        super().__init__(name, help_text)
+        self.func = func
+
+    def snapshot(self):
+        return {(): self.func()}
+
+    def _samples(self):
+        yield f"{self.name} {self.merged()[()]}"
+
+class Histogram(Metric):
+    """Distribution of observed values, counted into fixed buckets
+
+    Each series is [bucket counts, count, sum]; the last bucket count is
+    for values above the largest bound (+Inf).
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = buckets
+
+    @staticmethod
+    def _copy(series):
+        return [list(series[0])] + series[1:]
+
+    @staticmethod
+    def _add(series, other):
+        return [[a + b for a, b in zip(series[0], other[0])], series[1] + other[1], series[2] + other[2]]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += 1
+            series[2] += value
+
+    def quantile(self, series, q):
+        """Return the upper bound of the bucket holding quantile q of a series"""
+        counts, count, _ = series
+        seen = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            seen += bucket_count
+            if seen >= q * count:
+                return bound
+        return float('inf')
+
+    def _samples(self):
+        for key, (counts, count, total) in sorted(self.merged().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{self._labels(key, [('le', bound)])} {cumulative}"
+            yield f"{self.name}_count{self._labels(key)} {count}"
+            yield f"{self.name}_sum{self._labels(key)} {total}"
+
+def render_metrics():
+    """Return every metric in the Prometheus text exposition format"""
+    return "\n".join(metric.render() for metric in metrics_registry) + "\n"
+
+# Hot-path instrumentation
+updates_handled = Counter("telegram_updates_handled_total", "Incoming messages handled, by kind", ("kind",))
+handler_seconds = Histogram("telegram_handler_seconds", "Time spent handling one incoming message")
+api_request_seconds = Histogram("telegram_api_request_seconds", "Bot API request latency, by method",
+                                ("method",))
+api_responses = Counter("telegram_api_responses_total",
+                        "Bot API responses, by method and HTTP status (error when unreachable)",
+                        ("method", "status"))
+download_bytes = Counter("telegram_media_download_bytes_total", "Bytes of incoming attachments downloaded")
+download_seconds = Histogram("telegram_media_download_seconds", "Time taken to download one attachment")
+display_latency = Histogram("telegram_display_latency_seconds",
+                            "Time from a notification being queued to it being drawn")
+updates_routed = Counter("telegram_updates_routed_total", "Updates passed to worker processes, by shard",
+                         ("shard",))
+errors_logged = Counter("telegram_errors_total", "Failures that were reported and recovered from, by source",
+                        ("source",))
+Gauge("telegram_display_queue_depth", "Notifications waiting for the display thread",
+      lambda: message_queue.qsize())
+Gauge("telegram_pending_deletions", "Timed deletions not yet carried out, across all bots",
+      lambda: sum(len(instance.deletion_scheduler) for instance in bots.values()))
+Gauge("telegram_active_chats", "Chats held in memory, across all bots",
+      lambda: sum(len(instance.active_chats) for instance in bots.values()))
+
+# Outbound Bot API settings
+API_BASE_URL = os.environ.get('TELEGRAM_API_URL', "https://api.telegram.org")  # fake_bot_api.py in load tests
+API_POOL_SIZE = 16  # Max pooled keep-alive connections
+API_TIMEOUT = 30  # Seconds before an outbound request is abandoned
+
+# Telegram's flood limits for sent messages
+API_GLOBAL_RATE = 30  # Messages per second across all chats
+API_CHAT_RATE = 1  # Messages per second to one private chat
+API_GROUP_RATE = 20 / 60  # Messages per second to one group
+API_CHAT_BURST = 3  # Messages a chat may receive back to back before throttling kicks in
+API_MAX_RETRIES = 5  # Retries after a 429, a 5xx or a failed connection
+API_RETRY_BASE_DELAY = 1  # Seconds before the first retry, doubled on each further one
+API_RETRY_MAX_DELAY = 60  # Longest wait between two retries
+
+class TokenBucket:
+    """Token bucket handing out send slots at a fixed rate
+
+    reserve() takes a token even when none is free yet and returns how long
+    the caller must wait before using it, so threads and coroutines can share
+    a bucket and each sleep in their own way.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token and return the seconds to wait before it may be used"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+class ConnectionPool:
+    """Keep-alive connections to the Bot API, shared by every bot's client"""
+
+    def __init__(self, size=API_POOL_SIZE, timeout=API_TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        
+        # requests.Session reuses connections from a thread-safe urllib3 pool
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        
+        # The async client is bound to the running event loop, so create it lazily
+        self._async_client = None
+
+    def async_client(self):
+        if self._async_client is None:
+            limits = httpx.Limits(max_connections=self.size, max_keepalive_connections=self.size)
+            self._async_client = httpx.AsyncClient(timeout=self.timeout, limits=limits)
+        return self._async_client
+
+    async def aclose(self):
+        """Close the async connection pool"""
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+    def close(self):
+        """Close the thread-side connection pool"""
+        self.session.close()
+
+api_pool = ConnectionPool()
+
+class BotAPIClient:
+    """Bot API client for one bot token, sending over the shared connection pool
+
+    call() is thread-safe and meant for the console and worker threads,
+    acall() is for coroutines running on the bot's event loop. Both wait
+    for a free slot in the global and per-chat token buckets before sending
+    a message, and retry 429s (after retry_after), 5xx responses and failed
+    connections with exponential backoff. Sends are not idempotent: a 5xx
+    or a dropped connection may come after the message was delivered, so
+    they are only retried after a 429 or a connection that failed before
+    the request went out. The last response is returned if every retry
+    fails. Telegram's flood limits apply per bot, so each client has its
+    own buckets.
+    """
+
+    def __init__(self, token, pool=api_pool, max_retries=API_MAX_RETRIES, api_url=API_BASE_URL):
+        self.base_url = f"{api_url}/bot{token}"
+        self.file_url = f"{api_url}/file/bot{token}"
+        self.pool = pool
+        self.timeout = pool.timeout
+        self.max_retries = max_retries
+        
+        # Outbound message rate limits
+        self._global_bucket = TokenBucket(API_GLOBAL_RATE, API_GLOBAL_RATE)
+        self._chat_buckets = {}  # chat_id -> TokenBucket
+        self._buckets_lock = threading.Lock()
+
+    def _throttle(self, method, fields):
+        """Reserve a send slot and return the seconds to wait for it"""
+        if not method.startswith('send'):
+            return 0.0
+        delay = self._global_bucket.reserve()
+        chat_id = (fields or {}).get('chat_id')
+        if chat_id is not None:
+            chat_id = int(chat_id)
+            with self._buckets_lock:
+                bucket = self._chat_buckets.get(chat_id)
+                if bucket is None:
+                    # Negative ids are groups, which Telegram limits far more tightly
+                    rate = API_GROUP_RATE if chat_id < 0 else API_CHAT_RATE
+                    bucket = self._chat_buckets[chat_id] = TokenBucket(rate, API_CHAT_BURST)
+            delay = max(delay, bucket.reserve())
+        return delay
+
+    def _retry_delay(self, method, response, attempt):
+        """Return the seconds to wait before retrying a response, or None to give up"""
+        if attempt >= self.max_retries:
+            return None
+        if response is None or (response.status_code >= 500 and not method.startswith('send')):
+            return min(API_RETRY_BASE_DELAY * 2 ** attempt, API_RETRY_MAX_DELAY)
+        if response.status_code == 429:
+            try:
+                retry_after = response.json()['parameters']['retry_after']
+            except (ValueError, KeyError, TypeError):
+                retry_after = API_RETRY_BASE_DELAY * 2 ** attempt
+            print(f"Rate limited by Telegram, retrying in {retry_after} seconds...")
+            return retry_after
+        return None
+
+    @staticmethod
+    def _record(method, started, response):
+        """Count one request attempt and how long it took"""
+        api_request_seconds.observe(time.perf_counter() - started, method=method)
+        api_responses.inc(method=method, status=response.status_code if response is not None else "error")
+
+    def call(self, method, data=None, files=None, upload=None):
+        """Call a Bot API method from a regular thread
+
+        Pass a MultipartUpload as upload to stream a file instead of using files.
+        """
+        url = f"{self.base_url}/{method}"
+        attempt = 0
+        while True:
+            time.sleep(self._throttle(method, upload.fields if upload is not None else data))
+            started = time.perf_counter()
+            try:
+                if upload is not None:
+                    response = self.pool.session.post(url, data=upload, timeout=self.timeout,
+                                                      headers={'Content-Type': upload.content_type})
+                else:
+                    response = self.pool.session.post(url, data=data, files=files, timeout=self.timeout)
+            except requests.ConnectionError as e:
+                if method.startswith('send') and not self._never_sent(e):
+                    # Dropped after the message went out, it may have been delivered
+                    self._record(method, started, None)
+                    raise
+                response = None
+            self._record(method, started, response)
+            
+            delay = self._retry_delay(method, response, attempt)
+            if delay is None:
+                if response is None:
+                    raise requests.ConnectionError(f"Could not reach Telegram for {method}")
+                return response
+            attempt += 1
+            time.sleep(delay)
+
+    @staticmethod
+    def _never_sent(error):
+        """Return whether a requests ConnectionError came before any of the request was sent"""
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], 'reason', None) if error.args else None  # urllib3's MaxRetryError
+        return isinstance(reason, NewConnectionError)
+
+    async def acall(self, method, data=None, files=None):
+        """Call a Bot API method without blocking the event loop"""
+        url = f"{self.base_url}/{method}"
+        attempt = 0
+        while True:
+            await asyncio.sleep(self._throttle(method, data))
+            started = time.perf_counter()
+            try:
+                response = await self.pool.async_client().post(url, data=data, files=files)
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                # Raised before the request went out, so sending it again is safe
+                response = None
+            self._record(method, started, response)
+            
+            delay = self._retry_delay(method, response, attempt)
+            if delay is None:
+                if response is None:
+                    raise httpx.ConnectError(f"Could not reach Telegram for {method}")
+                return response
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def adownload(self, file_id, path, max_size):
+        """Stream a file from Telegram to path and return its size
+
+        Only DOWNLOAD_CHUNK_SIZE bytes are held in memory at once. Raises
+        MediaTooLarge as soon as more than max_size bytes arrive, whatever
+        size the file was announced with.
+        """
+        response = await self.acall('getFile', data={'file_id': file_id})
+        result = response.json()
+        if response.status_code != 200:
+            raise RuntimeError(result.get('description', f"HTTP {response.status_code}"))
+        url = f"{self.file_url}/{result['result']['file_path']}"
+        
+        written = 0
+        async with self.pool.async_client().stream('GET', url) as response:
+            response.raise_for_status()
+            with open(path, 'wb') as f:
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    written += len(chunk)
+                    if written > max_size:
+                        raise MediaTooLarge(f"over the {format_size(max_size)} download limit")
+                    f.write(chunk)
+        return written
+
+UPLOAD_CHUNK_SIZE = 64 * 1024  # Bytes read from disk per upload chunk
+
+class MultipartUpload:
+    """A multipart/form-data request body streamed from a file on disk
+
+    Iterating yields the body chunk by chunk, so only UPLOAD_CHUNK_SIZE bytes
+    of the file are held in memory at once. len() gives the Content-Length
+    up front so the request is not sent with chunked encoding.
+    """
+
+    def __init__(self, fields, file_field, path, progress=None):
+        self.fields = fields
+        self.path = path
+        self.progress = progress  # Called as progress(bytes_sent, file_size)
+        self.file_size = os.path.getsize(path)
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        
+        head = b""
+        for name, value in fields.items():
+            head += (f"--{boundary}\r\n"
+                     f"Content-Disposition: form-data; name=\"{name}\"\r\n\r\n"
+                     f"{value}\r\n").encode()
+        mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        head += (f"--{boundary}\r\n"
+                 f"Content-Disposition: form-data; name=\"{file_field}\"; "
+                 f"filename=\"{os.path.basename(path)}\"\r\n"
+                 f"Content-Type: {mime_type}\r\n\r\n").encode()
+        self._head = head
+        self._tail = f"\r\n--{boundary}--\r\n".encode()
+
+    def __len__(self):
+        return len(self._head) + self.file_size + len(self._tail)
+
+    def __iter__(self):
+        yield self._head
+        sent = 0
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                sent += len(chunk)
+                yield chunk
+                if self.progress:
+                    self.progress(sent, self.file_size)
+        yield self._tail
+
+def print_upload_progress(sent, total):
+    """Show upload progress on a single console line"""
+    percent = sent * 100 // total if total else 100
+    print(f"\rUploading... {percent}% ({sent // 1024} of {total // 1024} KB)",
+          end="\n" if sent >= total else "", flush=True)
+
+# Chat history storage settings
+HISTORY_DB = "chat_history.db"
+LEGACY_HISTORY_FILE = "chat_history.pkl"  # Imported once into HISTORY_DB
+HISTORY_FLUSH_INTERVAL = 0.5  # Max seconds a write waits before being committed
+HISTORY_BATCH_SIZE = 500  # Max writes committed (and fsynced) together
+HISTORY_RETRY_MAX_DELAY = 30  # Longest wait before retrying a batch the database could not take
+# SQLite errors that pass (a lock is released, disk space is freed), so a batch is retried
+HISTORY_RETRY_ERRORS = ("locked", "busy", "full", "disk I/O error", "unable to open")
+
+class HistoryStore:
+    """Crash-safe chat history journal backed by SQLite in WAL mode
+
+    Writes are queued and committed in batches by a background thread, so a
+    crash loses at most HISTORY_FLUSH_INTERVAL seconds of history and callers
+    never wait on the disk. Reads go straight to the database, so startup
+    does not depend on how much history has been stored.
+    """
+
+    # Outgoing messages are seen once the chat's watermark has passed them,
+    # worked out when reading so marking them never rewrites history rows
+    _SEEN = "(m.seen OR (m.direction = 'outgoing' AND m.message_id < COALESCE(c.seen_upto, 0)))"
+    MESSAGE_COLUMNS = ('chat_id', 'message_id', 'ts', 'direction', 'type',
+                       'text', 'filename', 'local_path', 'seen')
+    _INSERT_MESSAGE = (f"INSERT INTO messages ({', '.join(MESSAGE_COLUMNS)}) "
+                       f"VALUES ({', '.join('?' * len(MESSAGE_COLUMNS))})")
+
+    def __init__(self, path=HISTORY_DB, import_legacy=True):
+        self.path = path
+        self.full_text = True  # False if this SQLite build lacks FTS5
+        self._writes = queue.Queue()
+        self._read_lock = threading.Lock()
+        
+        # The writer thread gets its own connection, readers share this one
+        self._reader = self._connect()
+        self._create_schema(self._reader)
+        if import_legacy:
+            self._import_legacy_pickle()
+        
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")  # fsync once per committed batch
+        return conn
+
+    def _create_schema(self, conn):
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER,
+                ts REAL NOT NULL,
+                direction TEXT NOT NULL,
+                type TEXT NOT NULL,
+                text TEXT,
+                filename TEXT,
+                local_path TEXT,
+                seen INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages (chat_id, ts);
+            -- set_local_path() finds a message by its Telegram id
+            CREATE INDEX IF NOT EXISTS idx_messages_message ON messages (chat_id, message_id);
+            CREATE TABLE IF NOT EXISTS chats (
+                chat_id INTEGER PRIMARY KEY,
+                name TEXT,
+                username TEXT,
+                seen_upto INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS pending_deletions (
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                delete_time REAL NOT NULL,
+                PRIMARY KEY (chat_id, message_id)
+            );
+            CREATE TABLE IF NOT EXISTS file_ids (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                file_id TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(chats)")]
+        if 'seen_upto' not in columns:
+            # Databases from before the watermark was stored
+            conn.execute("ALTER TABLE chats ADD COLUMN seen_upto INTEGER NOT NULL DEFAULT 0")
+        conn.commit()
+        self._create_search_index(conn)
+
+    def _create_search_index(self, conn):
+        """Keep an FTS5 index of message text in step with the messages table"""
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+        try:
+            conn.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+                    USING fts5(text, filename, content='messages', content_rowid='id');
+                CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                    INSERT INTO messages_fts (rowid, text, filename)
+                    VALUES (new.id, new.text, new.filename);
+                END;
+                CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                    INSERT INTO messages_fts (messages_fts, rowid, text, filename)
+                    VALUES ('delete', old.id, old.text, old.filename);
+                END;
+            """)
+        except sqlite3.OperationalError:
+            print("Full-text search unavailable, /search will scan history")
+            self.full_text = False
+            return
+        if not exists:
+            # Index history stored before the search index existed
+            conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+        conn.commit()
+
+    def _import_legacy_pickle(self):
+        """Import chat_history.pkl from older versions, once"""
+        if not os.path.exists(LEGACY_HISTORY_FILE):
+            return
+        done = self._reader.execute("SELECT value FROM meta WHERE key = 'legacy_imported'").fetchone()
+        if done:
+            return
+        
+        with open(LEGACY_HISTORY_FILE, "rb") as f:
+            legacy_history = pickle.load(f)
+        
+        rows = [self._message_row(chat_id, Message.from_dict(msg))
+                for chat_id, messages in legacy_history.items()
+                for msg in messages]
+        with self._read_lock, self._reader:
+            self._reader.executemany(self._INSERT_MESSAGE, rows)
+            self._reader.executemany("INSERT OR IGNORE INTO chats (chat_id) VALUES (?)",
+                                     [(chat_id,) for chat_id in legacy_history])
+            self._reader.execute("INSERT INTO meta (key, value) VALUES ('legacy_imported', ?)",
+                                 (LEGACY_HISTORY_FILE,))
+        
+        os.replace(LEGACY_HISTORY_FILE, LEGACY_HISTORY_FILE + ".imported")
+        print(f"Imported {len(rows)} messages from {LEGACY_HISTORY_FILE}")
+
+    @staticmethod
+    def _message_row(chat_id, msg):
+        # Direction and type are stored by name so the database stays readable
+        return (chat_id, msg.message_id, msg.ts, msg.direction.name.lower(),
+                msg.kind.name.lower(), msg.text, msg.filename, msg.local_path, int(msg.seen))
+
+    @staticmethod
+    def _message_from_row(row):
+        message_id, ts, direction, msg_type, text, filename, local_path, seen = row
+        return Message(message_id, Direction[direction.upper()], MessageType[msg_type.upper()],
+                       ts=ts, text=text, filename=filename, local_path=local_path, seen=bool(seen))
+
+    def _write_loop(self):
+        """Commit queued writes in batches"""
+        conn = self._connect()
+        while True:
+            batch = [self._writes.get()]
+            deadline = time.monotonic() + HISTORY_FLUSH_INTERVAL
+            # Stop gathering as soon as someone is waiting on a flush
+            while len(batch) < HISTORY_BATCH_SIZE and batch[-1][0] != 'flush':
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._writes.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            self._commit(conn, [args for op, args in batch if op != 'flush'])
+            for op, event in batch:
+                if op == 'flush':
+                    event.set()
+
+    def _commit(self, conn, statements):
+        """Commit a batch of writes, retrying until the database takes it
+
+        A locked database or a full disk is retried with backoff and the
+        batch kept, so queued history is never dropped. If the database
+        rejects a statement itself, the others are committed one at a time
+        and only that statement is dropped.
+        """
+        attempt = 0
+        while True:
+            try:
+                with conn:
+                    for args in statements:
+                        conn.execute(*args)
+                return
+            except sqlite3.Error as e:
+                if not any(words in str(e) for words in HISTORY_RETRY_ERRORS):
+                    rejected = e
+                    break
+                delay = min(HISTORY_FLUSH_INTERVAL * 2 ** attempt, HISTORY_RETRY_MAX_DELAY)
+                print(f"Error saving chat history, retrying in {delay:g} seconds: {e}")
+                attempt += 1
+                time.sleep(delay)
+        
+        if len(statements) == 1:
+            print(f"Error saving chat history, dropping one write: {rejected}")
+            return
+        for args in statements:
+            self._commit(conn, [args])
+
+    def append(self, chat_id, msg):
+        """Queue a message to be appended to the chat's history"""
+        self._writes.put(('sql', (self._INSERT_MESSAGE, self._message_row(chat_id, msg))))
+
+    def save_chat(self, chat_id, name, username):
+        """Queue the chat's display name to be stored"""
+        self._writes.put(('sql', ("INSERT INTO chats (chat_id, name, username) VALUES (?, ?, ?) "
+                                  "ON CONFLICT (chat_id) DO UPDATE SET name = excluded.name, "
+                                  "username = excluded.username",
+                                  (chat_id, name, username))))
+
+    def mark_seen(self, chat_id, seen_upto):
+        """Queue the chat's seen watermark to move up to seen_upto, a single-row write"""
+        self._writes.put(('sql', ("INSERT INTO chats (chat_id, seen_upto) VALUES (?, ?) "
+                                  "ON CONFLICT (chat_id) DO UPDATE SET seen_upto = MAX(seen_upto, excluded.seen_upto)",
+                                  (chat_id, seen_upto))))
+
+    def set_local_path(self, chat_id, message_id, local_path):
+        """Queue the path a downloaded image was saved at to be stored"""
+        self._writes.put(('sql', ("UPDATE messages SET local_path = ? WHERE chat_id = ? AND message_id = ?",
+                                  (local_path, chat_id, message_id))))
+
+    def delete_chat(self, chat_id):
+        """Queue a chat's whole history to be deleted"""
+        self._writes.put(('sql', ("DELETE FROM messages WHERE chat_id = ?", (chat_id,))))
+        self._writes.put(('sql', ("DELETE FROM chats WHERE chat_id = ?", (chat_id,))))
+
+    def save_deletion(self, chat_id, message_id, delete_time):
+        """Queue a timed deletion to be stored so it survives a restart"""
+        self._writes.put(('sql', ("INSERT OR REPLACE INTO pending_deletions (chat_id, message_id, delete_time) "
+                                  "VALUES (?, ?, ?)", (chat_id, message_id, delete_time))))
+
+    def remove_deletion(self, chat_id, message_id):
+        """Queue a completed timed deletion to be forgotten"""
+        self._writes.put(('sql', ("DELETE FROM pending_deletions WHERE chat_id = ? AND message_id = ?",
+                                  (chat_id, message_id))))
+
+    def load_deletions(self):
+        """Return every stored timed deletion as (delete_time, chat_id, message_id)"""
+        with self._read_lock:
+            return self._reader.execute(
+                "SELECT delete_time, chat_id, message_id FROM pending_deletions").fetchall()
+
+    def save_file_id(self, path, file_id):
+        """Queue the Telegram file_id of an uploaded local file to be remembered"""
+        stat = os.stat(path)
+        self._writes.put(('sql', ("INSERT OR REPLACE INTO file_ids (path, size, mtime_ns, file_id) "
+                                  "VALUES (?, ?, ?, ?)",
+                                  (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, file_id))))
+
+    def get_file_id(self, path):
+        """Return the file_id a local file was uploaded as, unless it changed since"""
+        stat = os.stat(path)
+        self.flush()
+        with self._read_lock:
+            row = self._reader.execute(
+                "SELECT file_id FROM file_ids WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)).fetchone()
+        return row[0] if row else None
+
+    def flush(self, timeout=5):
+        """Wait until every queued write has been committed"""
+        event = threading.Event()
+        self._writes.put(('flush', event))
+        return event.wait(timeout)
+
+    def count_messages(self, chat_id, since=None):
+        """Return how many messages a chat has stored, optionally only from since on"""
+        self.flush()
+        with self._read_lock:
+            if since is None:
+                row = self._reader.execute("SELECT COUNT(*) FROM messages WHERE chat_id = ?",
+                                           (chat_id,)).fetchone()
+            else:
+                row = self._reader.execute("SELECT COUNT(*) FROM messages WHERE chat_id = ? AND ts >= ?",
+                                           (chat_id, since.timestamp())).fetchone()
+        return row[0]
+
+    def load_page(self, chat_id, limit, offset=0):
+        """Return up to limit messages, skipping the offset newest ones, oldest first"""
+        self.flush()
+        with self._read_lock:
+            rows = self._reader.execute(
+                "SELECT m.message_id, m.ts, m.direction, m.type, m.text, m.filename, m.local_path, "
+                f"{self._SEEN} FROM messages m LEFT JOIN chats c ON c.chat_id = m.chat_id "
+                "WHERE m.chat_id = ? ORDER BY m.ts DESC, m.id DESC LIMIT ? OFFSET ?",
+                (chat_id, limit, offset)).fetchall()
+        return [self._message_from_row(row) for row in reversed(rows)]
+
+    @staticmethod
+    def _match_query(terms):
+        """Quote each word or phrase so FTS5 matches it literally, all terms required"""
+        return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+    def search(self, terms, chat_id=None, since=None, until=None, limit=SEARCH_LIMIT):
+        """Return (chat_id, chat_name, message) for messages containing every term, newest first
+
+        terms are words or phrases. The search covers one chat if chat_id is
+        given, otherwise every chat, and can be limited to since <= time < until.
+        """
+        if self.full_text:
+            sql = ("SELECT m.chat_id, c.name, m.message_id, m.ts, m.direction, m.type, m.text, "
+                   f"m.filename, m.local_path, {self._SEEN} "
+                   "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                   "LEFT JOIN chats c ON c.chat_id = m.chat_id "
+                   "WHERE messages_fts MATCH ?")
+            params = [self._match_query(terms)]
+        else:
+            sql = ("SELECT m.chat_id, c.name, m.message_id, m.ts, m.direction, m.type, m.text, "
+                   f"m.filename, m.local_path, {self._SEEN} "
+                   "FROM messages m LEFT JOIN chats c ON c.chat_id = m.chat_id WHERE 1")
+            params = []
+            for term in terms:
+                sql += " AND (m.text LIKE ? OR m.filename LIKE ?)"
+                params += [f"%{term}%"] * 2
+        if chat_id is not None:
+            sql += " AND m.chat_id = ?"
+            params.append(chat_id)
+        if since is not None:
+            sql += " AND m.ts >= ?"
+            params.append(since.timestamp())
+        if until is not None:
+            sql += " AND m.ts < ?"
+            params.append(until.timestamp())
+        sql += " ORDER BY m.ts DESC LIMIT ?"
+        params.append(limit)
+        
+        self.flush()
+        with self._read_lock:
+            rows = self._reader.execute(sql, params).fetchall()
+        return [(row[0], row[1], self._message_from_row(row[2:])) for row in rows]
+
+    def chat_count(self):
+        """Return the number of chats with stored history"""
+        with self._read_lock:
+            return self._reader.execute("SELECT COUNT(*) FROM chats").fetchone()[0]
+
+    def close(self):
+        """Commit pending writes and close the database"""
+        self.flush()
+        with self._read_lock:
+            self._reader.close()
+
+class DeletionScheduler:
+    """Min-heap of timed deletions keyed by deadline
+
+    The worker sleeps exactly until the earliest deadline (or until an
+    earlier one is scheduled), so pending timers cost nothing while waiting.
+    """
+
+    def __init__(self, entries=()):
+        self._heap = list(entries)  # (delete_time, chat_id, message_id)
+        heapq.heapify(self._heap)
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, chat_id, message_id, delete_time):
+        """Add a deletion and wake the worker if it is now the earliest"""
+        with self._cond:
+            heapq.heappush(self._heap, (delete_time, chat_id, message_id))
+            if self._heap[0][0] == delete_time:
+                self._cond.notify()
+
+    def wait_next(self):
+        """Block until a deletion is due and return (chat_id, message_id)"""
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                delay = self._heap[0][0] - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                _, chat_id, message_id = heapq.heappop(self._heap)
+                return chat_id, message_id
+
+DELETION_RETRY_MAX_DELAY = 300  # Longest wait before retrying a failed timed deletion
+
+def schedule_deletion(instance, chat_id, message_id, timer_seconds):
+    """Delete a message a bot sent after timer_seconds, even across restarts"""
+    delete_time = time.time() + timer_seconds
+    instance.history_store.save_deletion(chat_id, message_id, delete_time)
+    instance.deletion_scheduler.schedule(chat_id, message_id, delete_time)
+
+WORD_CHAR = re.compile(r'\w')
+
+def build_trie(words):
+    """Return words as a trie of nested dicts, with '' marking where a word ends"""
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = None  # A trigger ends here
+    return trie
+
+def trie_pattern(trie):
+    """Build a regex matching any word of a trie, shaped as the trie
+
+    Python's re tries alternatives one by one, so a flat a|b|c over thousands
+    of triggers costs rules x text length. Sharing prefixes means each text
+    position only walks as deep as the longest trigger starting there.
+    """
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        group = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            return ('(?:' + group + ')?') if len(branches) == 1 else group + '?'
+        return group
+    
+    return build(trie)
+
+class AutoReplyEngine:
+    """Auto-reply rules matched against a message in a single regex pass
+
+    Rules come from AUTO_REPLY_FILE as {"trigger", "reply", "priority",
+    "whole_word"}. When several triggers match, the highest priority wins,
+    then the rule listed first. whole_word (the default) stops "hi" from
+    matching "this". Each chat gets at most one reply per rate_limit_seconds.
+    """
+
+    def __init__(self, path=AUTO_REPLY_FILE):
+        self.path = path
+        self._mtime = None
+        self._next_check = 0
+        self._last_reply = {}  # chat_id -> time of the last auto-reply
+        self._load_rules(DEFAULT_AUTO_REPLIES)
+        self.reload_if_changed()
+
+    def _load_rules(self, config):
+        rules = {}  # (trigger, whole_word) -> (priority, order, reply)
+        for order, rule in enumerate(config['rules']):
+            key = (rule['trigger'].strip().lower(), rule.get('whole_word', True))
+            rank = (rule.get('priority', 0), -order)
+            if key[0] and (key not in rules or rank > rules[key][:2]):
+                rules[key] = rank + (rule['reply'],)
+        
+        self._word_trie = build_trie(trigger for trigger, whole_word in rules if whole_word)
+        self._part_trie = build_trie(trigger for trigger, whole_word in rules if not whole_word)
+        # Lookaheads let matches overlap, so a trigger inside a longer one is still seen
+        self._word_pattern = re.compile(r'(?<!\w)(?=(' + trie_pattern(self._word_trie) + r')(?!\w))'
+                                        if self._word_trie else r'(?!)')
+        self._part_pattern = re.compile(r'(?=(' + trie_pattern(self._part_trie) + r'))'
+                                        if self._part_trie else r'(?!)')
+        self._rules = rules
+        self.rate_limit = config.get('rate_limit_seconds', 0)
+
+    def reload_if_changed(self):
+        """Reload the rules file if it was edited, keeping the old rules if it is invalid"""
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + AUTO_REPLY_RELOAD_INTERVAL
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return  # No rules file, keep the rules already loaded
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self._load_rules(json.load(f))
+            print(f"Loaded {len(self._rules)} auto-reply rules from {self.path}")
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            print(f"Error loading {self.path}, keeping previous auto-replies: {e}")
+
+    @staticmethod
+    def _triggers_at(trie, text, start, end, whole_word):
+        """Yield every trigger of trie in text[start:end] that starts at start"""
+        node = trie
+        for i in range(start, end):
+            node = node[text[i]]
+            if '' in node and not (whole_word and WORD_CHAR.match(text, i + 1)):
+                yield text[start:i + 1]
+
+    def match(self, chat_id, text):
+        """Return the reply for the best matching rule, or None"""
+        self.reload_if_changed()
+        best = None
+        for trie, pattern, whole_word in ((self._word_trie, self._word_pattern, True),
+                                          (self._part_trie, self._part_pattern, False)):
+            for m in pattern.finditer(text):
+                # The regex reports the longest trigger starting here, a shorter one may rank higher
+                for trigger in self._triggers_at(trie, text, m.start(1), m.end(1), whole_word):
+                    rule = self._rules[(trigger, whole_word)]
+                    if best is None or rule[:2] > best[:2]:
+                        best = rule
+        if best is None:
+            return None
+        
+        now = time.monotonic()
+        if now - self._last_reply.get(chat_id, -self.rate_limit) < self.rate_limit:
+            return None
+        self._last_reply[chat_id] = now
+        return best[2]
+
+class BotInstance:
+    """One bot hosted by this process
+
+    Each bot has its own Application, chats, history database, timed
+    deletions, auto-reply rate limits and flood limits. The event loop, the
+    connection pool and the console are shared by all of them.
+    """
+
+    def __init__(self, name, token, history_path=HISTORY_DB, import_legacy=False):
+        self.name = name
+        self.token = token
+        self.api = BotAPIClient(token)
+        self.active_chats = ChatStore()
+        self.auto_replies = AutoReplyEngine()
+        # No history_path in the front process of --workers, where the workers keep the history
+        self.history_store = None
+        self.deletion_scheduler = DeletionScheduler()
+        if history_path is not None:
+            self.history_store = HistoryStore(history_path, import_legacy=import_legacy)
+            deletions = self.history_store.load_deletions()
+            if worker_shard is not None:
+                # The database is shared by all workers, each deleting in its own chats
+                shard, count = worker_shard
+                deletions = [entry for entry in deletions if entry[1] % count == shard]
+            self.deletion_scheduler = DeletionScheduler(deletions)
+        self.app = None  # Application, built in main()
+
+    def unread(self):
+        return sum(chat['unread'] for _, chat in self.active_chats.items())
+
+def enqueue_display(item):
+    """Queue a notification and wake the display thread"""
+    if headless:
+        return  # Nobody is watching, so nothing is rendered
+    item['enqueued_at'] = time.monotonic()
+    message_queue.put(item)
+
+def request_refresh():
+    """Ask the display thread to redraw the current screen"""
+    global refresh_needed
+    refresh_needed = True
+    enqueue_display({'type': 'refresh'})
+
+def get_queue_stats():
+    """Return display queue depth and enqueue-to-render latency in seconds"""
+    rendered = queue_stats['rendered']
+    return {
+        'depth': message_queue.qsize(),
+        'rendered': rendered,
+        'avg_latency': queue_stats['total_latency'] / rendered if rendered else 0.0,
+        'last_latency': queue_stats['last_latency'],
+        'max_latency': queue_stats['max_latency']
+    }
+
+class ScreenRenderer:
+    """Console output that redraws a screen by rewriting only the changed lines
+
+    Installed as sys.stdout. Whatever a screen prints inside frame() is
+    captured into a frame buffer and compared with the frame already on
+    screen, and only lines that differ are rewritten, using ANSI cursor
+    movement. Output printed between frames (notifications, prompts) passes
+    straight through; if it may have scrolled the screen, or a line may have
+    wrapped, the next frame is drawn in full.
+    """
+
+    def __init__(self, out):
+        self._out = out
+        self._lines = []  # The frame currently on screen
+        self._full_redraw = True
+        self._rows_below = 0  # Rows printed under the frame since it was drawn
+        self._capture = None  # (thread id, buffer) while a frame is being printed
+        self.ansi = out.isatty()
+        if self.ansi and os.name == 'nt':
+            os.system('')  # Turns on ANSI escape handling in the Windows console
+
+    def write(self, text):
+        capture = self._capture
+        if capture is not None and capture[0] == threading.get_ident():
+            capture[1].append(text)
+            return len(text)
+        self._rows_below += text.count('\n')
+        return self._out.write(text)
+
+    def flush(self):
+        self._out.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._out, name)
+
+    def clear(self):
+        """Draw the next frame from scratch"""
+        self._full_redraw = True
+
+    @contextlib.contextmanager
+    def frame(self):
+        """Capture the screen printed inside the block, then draw what changed"""
+        with console_lock:
+            buffer = []
+            self._capture = (threading.get_ident(), buffer)
+            try:
+                yield
+            finally:
+                self._capture = None
+            self._draw(''.join(buffer).split('\n')[:-1])
+
+    def _draw(self, lines):
+        if not self.ansi:
+            # Not a terminal, so there is nothing to redraw in place
+            self._out.write(''.join(line + '\n' for line in lines))
+            self._out.flush()
+            return
+        
+        columns, rows = shutil.get_terminal_size()
+        full = (self._full_redraw or
+                len(lines) + self._rows_below + RENDER_SCROLL_MARGIN >= rows or
+                any(len(line) >= columns for line in lines))
+        if full:
+            output = ['\x1b[H\x1b[2J'] + [line + '\n' for line in lines]
+        else:
+            output = [f'\x1b[{row};1H{line}\x1b[K'
+                      for row, (line, old) in enumerate(itertools.zip_longest(lines, self._lines[:len(lines)]), 1)
+                      if line != old]
+            # Leave the cursor under the frame and wipe anything printed below it
+            output.append(f'\x1b[{len(lines) + 1};1H\x1b[J')
+        self._out.write(''.join(output))
+        self._out.flush()
+        self._lines = lines
+        self._full_redraw = False
+        self._rows_below = 0
 
 def clear_console():
     """Clear the console screen"""
-    os.system('cls' if os.name == 'nt' else 'clear')
+    screen.clear()
+
+def page_offset(screen, total):
+    """Return the screen's scroll offset clamped to the messages available"""
+    offset = max(0, min(view_offsets.get(screen, 0), total - PAGE_SIZE))
+    view_offsets[screen] = offset
+    return offset
+
+def window_messages(messages, offset, size=PAGE_SIZE):
+    """Return (start, page) for one page of a chat's in-memory messages
+
+    Walks back from the newest message, so the cost depends on the page
+    position rather than the size of the chat.
+    """
+    newest_first = itertools.islice(reversed(messages.values()), offset, offset + size)
+    page = list(newest_first)[::-1]
+    return len(messages) - offset - len(page), page
+
+def print_page_footer(start, count, total):
+    """Show which part of a paged message list is on screen"""
+    if total > count:
+        print(f"Showing messages {start + 1}-{start + count} of {total} (/up older, /down newer)")
+
+def record_message(instance, chat_id, msg):
+    """Add a message to a bot's chat window in memory and save it to history
+
+    Once a chat holds more than live_window_size messages the oldest are
+    dropped from memory. With history saving enabled they stay available to
+    the history view and /search, which read them back from disk.
+    """
+    instance.active_chats.add_message(chat_id, msg, live_window_size)
+    
+    # Save to permanent history if enabled
+    if save_history:
+        instance.history_store.append(chat_id, msg)
+
+def mark_outgoing_seen(instance, chat_id, message_id):
+    """Mark the chat's outgoing messages sent before message_id as seen
+
+    Only the chat's seen_upto watermark moves, so an incoming message costs
+    the same however many messages the chat holds.
+    """
+    if instance.active_chats.mark_seen_upto(chat_id, message_id) and save_history:
+        instance.history_store.mark_seen(chat_id, message_id)
+
+def is_seen(chat, msg):
+    """Return True if an outgoing message has been seen by the other side"""
+    if msg.direction != Direction.OUTGOING:
+        return False
+    return msg.seen or (msg.message_id is not None and msg.message_id < chat['seen_upto'])
 
 def display_image_notification(image_path, chat_name):
     """Display image notification in console"""
@@ -55,30 +1587,66 @@ def display_image_notification(image_path, chat_name):
 def display_main_interface():
     """Display the main interface with active chats"""
     global refresh_needed
-    with console_lock:
-        clear_console()
+    with screen.frame():
         print("╔════════════════════ TELEGRAM MESSENGER ═══════════════════════╗")
         print("║ Type /exit to quit, /refresh to refresh, /clear to clear      ║")
         print("║ Type /ids to show only chat IDs                               ║")
         print("║ Type /delete to delete a chat                                 ║")
         print("║ Type /settings to change message settings                     ║")
         print("║ Type /history to view chat history                            ║")
+        print("║ Type /search <words> to search all chats                      ║")
+        print("║ Type /broadcast to send one message to many chats             ║")
+        print("║ Type /find <name or @username> to look up a chat              ║")
+        print("║ Type /stats to see throughput and latency                     ║")
+        if len(bots) > 1:
+            print("║ Type /bots to list bots, /bot <name> to switch                ║")
         print("╚══════════════════════════════════════════════════════════════╝")
         print()
         
-        if not active_chats:
+        if len(bots) > 1:
+            print(f"Bot: {current_bot.name}")
+        
+        if not current_bot.active_chats:
             print("No active chats yet. Waiting for messages...")
         else:
-            print("Your active chats:")
-            print("─" * 60)
-            print("ID        Name")
-            print("─" * 60)
-            for chat_id, chat in active_chats.items():
-                unread = sum(1 for msg in chat['messages'] if msg['direction'] == 'incoming' and not msg.get('read', False))
-                unread_indicator = f" ({unread} new)" if unread > 0 else ""
-                print(f"{chat_id:<9} {chat['name']}{unread_indicator}")
-            
-            print("─" * 60)
+            print("Your active chats, most recent first:")
+            print_chat_list(current_bot.active_chats.recent(CHAT_LIST_SIZE))
+            older = len(current_bot.active_chats) - CHAT_LIST_SIZE
+            if older > 0:
+                print(f"...and {older} older chats, use /find to look one up")
+        
+        print("\nEnter chat ID to reply or command:")
+        refresh_needed = False
+
+def print_chat_list(chats):
+    """Print (chat_id, chat) pairs as a table of IDs, names and unread counts"""
+    print("─" * 60)
+    print("ID        Name")
+    print("─" * 60)
+    for chat_id, chat in chats:
+        unread = chat['unread']
+        unread_indicator = f" ({unread} new)" if unread > 0 else ""
+        username = f" @{chat['username']}" if chat['username'] else ""
+        print(f"{chat_id:<9} {chat['name']}{username}{unread_indicator}")
+    print("─" * 60)
+
+def display_find_results(prefix):
+    """Display the chats whose name or username starts with prefix"""
+    global refresh_needed
+    with screen.frame():
+        print(f"╔════════════════════ FIND: {prefix} ════════════════════╗")
+        print("║ Type /back to return to main screen                           ║")
+        print("║ Enter a chat ID to open that chat                             ║")
+        print("╚══════════════════════════════════════════════════════════════╝")
+        print()
+        
+        matches = current_bot.active_chats.find(prefix, CHAT_LIST_SIZE + 1)
+        if not matches:
+            print("No chats match.")
+        else:
+            print_chat_list(matches[:CHAT_LIST_SIZE])
+            if len(matches) > CHAT_LIST_SIZE:
+                print(f"Showing the first {CHAT_LIST_SIZE} matches, type more of the name to narrow it down")
         
         print("\nEnter chat ID to reply or command:")
         refresh_needed = False
@@ -86,8 +1654,7 @@ def display_main_interface():
 def display_ids_only():
     """Display only chat IDs"""
     global refresh_needed
-    with console_lock:
-        clear_console()
+    with screen.frame():
         print("╔════════════════════ CHAT IDs ════════════════════╗")
         print("║ Type /back to return to main screen              ║")
         print("║ Type /delete to delete a chat                    ║")
@@ -95,13 +1662,13 @@ def display_ids_only():
         print("╚══════════════════════════════════════════════════╝")
         print()
         
-        if not active_chats:
+        if not current_bot.active_chats:
             print("No active chats yet. Waiting for messages...")
         else:
             print("Chat IDs:")
             print("─" * 30)
-            for chat_id, chat in active_chats.items():
-                unread = sum(1 for msg in chat['messages'] if msg['direction'] == 'incoming' and not msg.get('read', False))
+            for chat_id, chat in current_bot.active_chats.recent():
+                unread = chat['unread']
                 unread_indicator = f" ({unread} new)" if unread > 0 else ""
                 print(f"{chat_id}{unread_indicator}")
             
@@ -113,9 +1680,8 @@ def display_ids_only():
 def display_chat_interface(chat_id):
     """Display the chat interface for a specific chat"""
     global refresh_needed
-    with console_lock:
-        clear_console()
-        chat = active_chats[chat_id]
+    with screen.frame():
+        chat = current_bot.active_chats[chat_id]
         print(f"╔════════════════ CHAT WITH {chat['name'].upper()} ═════════════════╗")
         print(f"║ ID: {chat_id}                                                  ║")
         if chat.get('username'):
@@ -123,124 +1689,128 @@ def display_chat_interface(chat_id):
         print("║ Type /back to return, /refresh to refresh, /clear to clear  ║")
         print("║ Type /delete to delete this chat, /dmsg to delete messages  ║")
         print("║ Type /image to send photo, /timer to set timer for messages ║")
+        print("║ Type /document /video /voice /audio /sticker to send files  ║")
         print("║ Type /history to view complete chat history                 ║")
+        print("║ Type /up and /down to page through messages                 ║")
         print("╚══════════════════════════════════════════════════════════════╝")
         print()
         
         # Mark messages as read when viewing chat
-        for msg in chat['messages']:
-            if msg['direction'] == 'incoming':
-                msg['read'] = True
-        
-        # Display messages
-        for msg in chat['messages']:
-            timestamp = msg['time'].strftime("%H:%M")
-            seen_indicator = " ✓✓" if msg.get('seen') else " ✓" if msg['direction'] == 'outgoing' else ""
-            
-            if msg['direction'] == 'incoming':
-                if msg['type'] == 'text':
-                    print(f"{timestamp} {chat['name']}: {msg['text']}{seen_indicator}")
-                elif msg['type'] == 'image':
-                    print(f"{timestamp} {chat['name']}: [Image: {msg.get('filename', 'photo')}] 📸{seen_indicator}")
-                    if msg.get('local_path'):
-                        print(f"         📁 Saved at: {msg['local_path']}")
-            else:
-                if msg['type'] == 'text':
-                    print(f"{timestamp} You: {msg['text']}{seen_indicator}")
-                elif msg['type'] == 'image':
-                    print(f"{timestamp} You: [Image: {msg.get('filename', 'photo')}] 📸{seen_indicator}")
+        current_bot.active_chats.mark_read(chat_id)
+        
+        # Display the current page of messages
+        start, page = current_bot.active_chats.page(chat_id, page_offset(chat_id, len(chat['messages'])))
+        for msg in page:
+            timestamp = msg.time.strftime("%H:%M")
+            seen_indicator = " ✓✓" if is_seen(chat, msg) else " ✓" if msg.direction == Direction.OUTGOING else ""
+            sender = chat['name'] if msg.direction == Direction.INCOMING else "You"
+            print(f"{timestamp} {sender}: {message_content(msg)}{seen_indicator}")
+            if msg.local_path:
+                print(f"         📁 Saved at: {msg.local_path}")
         
         print("─" * 60)
+        print_page_footer(start, len(page), len(chat['messages']))
         print("Type your message or command:")
         refresh_needed = False
 
 def display_chat_history(chat_id):
     """Display complete chat history for a specific chat"""
     global refresh_needed
-    with console_lock:
-        clear_console()
-        chat = active_chats[chat_id]
+    with screen.frame():
+        chat = current_bot.active_chats[chat_id]
         
-        # Load complete history if available
-        all_messages = chat_history.get(chat_id, []) + chat['messages']
+        # Load one page of stored history, falling back to this session if nothing is stored
+        total = current_bot.history_store.count_messages(chat_id)
+        if total:
+            offset = page_offset(("history", chat_id), total)
+            page = current_bot.history_store.load_page(chat_id, PAGE_SIZE, offset)
+            start = total - offset - len(page)
+        else:
+            total = len(chat['messages'])
+            start, page = current_bot.active_chats.page(chat_id, page_offset(("history", chat_id), total))
         
         print(f"╔════════════════ CHAT HISTORY - {chat['name'].upper()} ═════════════════╗")
         print(f"║ ID: {chat_id}                                                  ║")
         print("║ Type /back to return to chat                                  ║")
-        print("║ Use ↑/↓ arrows to scroll, /search to find messages            ║")
+        print("║ Type /up and /down to page, /date YYYY-MM-DD to jump to a day ║")
+        print("║ Type /search to find messages                                 ║")
         print("╚══════════════════════════════════════════════════════════════╝")
         print()
         
-        if not all_messages:
+        if not page:
             print("No message history available.")
             print("\nType /back to return:")
             return
         
-        # Display all messages with date headers
+        # Display the page with date headers
         current_date = None
-        for msg in all_messages:
-            msg_date = msg['time'].strftime("%Y-%m-%d")
+        for msg in page:
+            msg_time = msg.time
+            msg_date = msg_time.strftime("%Y-%m-%d")
             if msg_date != current_date:
                 current_date = msg_date
-                print(f"\n📅 {msg['time'].strftime('%B %d, %Y')}")
+                print(f"\n📅 {msg_time.strftime('%B %d, %Y')}")
                 print("─" * 40)
             
-            timestamp = msg['time'].strftime("%H:%M")
-            seen_indicator = " ✓✓" if msg.get('seen') else " ✓" if msg['direction'] == 'outgoing' else ""
-            
-            if msg['direction'] == 'incoming':
-                if msg['type'] == 'text':
-                    print(f"{timestamp} {chat['name']}: {msg['text']}{seen_indicator}")
-                elif msg['type'] == 'image':
-                    print(f"{timestamp} {chat['name']}: [Image: {msg.get('filename', 'photo')}] 📸{seen_indicator}")
-            else:
-                if msg['type'] == 'text':
-                    print(f"{timestamp} You: {msg['text']}{seen_indicator}")
-                elif msg['type'] == 'image':
-                    print(f"{timestamp} You: [Image: {msg.get('filename', 'photo')}] 📸{seen_indicator}")
+            timestamp = msg_time.strftime("%H:%M")
+            seen_indicator = " ✓✓" if is_seen(chat, msg) else " ✓" if msg.direction == Direction.OUTGOING else ""
+            sender = chat['name'] if msg.direction == Direction.INCOMING else "You"
+            print(f"{timestamp} {sender}: {message_content(msg)}{seen_indicator}")
         
-        print("\n─" * 60)
+        print("\n" + "─" * 60)
+        print_page_footer(start, len(page), total)
         print("Type /back to return to chat:")
         refresh_needed = False
 
 def delete_chat_interface():
     """Display interface for deleting a chat"""
-    global refresh_needed
-    with console_lock:
-        clear_console()
+    global refresh_needed, delete_choices
+    with screen.frame():
         print("╔════════════════════ DELETE CHAT ════════════════════╗")
         print("║ Type /back to return to main screen                 ║")
         print("║ Type /history to view chat history                  ║")
+        print("║ Type /delete <name> to list chats by name           ║")
         print("╚═════════════════════════════════════════════════════╝")
         print()
         
-        if not active_chats:
-            print("No active chats to delete.")
+        # Remember what each number means, the recency order changes as messages arrive
+        if delete_filter:
+            chats = current_bot.active_chats.find(delete_filter, CHAT_LIST_SIZE)
+        else:
+            chats = current_bot.active_chats.recent(CHAT_LIST_SIZE)
+        delete_choices = [chat_id for chat_id, _ in chats]
+        
+        if not chats:
+            print("No matching chats to delete." if delete_filter else "No active chats to delete.")
             print("\nType /back to return:")
             return
         
-        print("Select chat to delete:")
+        print(f"Select chat to delete (names starting with {delete_filter}):" if delete_filter
+              else "Select chat to delete (most recent first):")
         print("─" * 60)
         print("ID        Name")
         print("─" * 60)
-        for i, (chat_id, chat) in enumerate(active_chats.items(), 1):
+        for i, (chat_id, chat) in enumerate(chats, 1):
             print(f"{i}. {chat_id:<9} {chat['name']}")
         
         print("─" * 60)
+        older = len(current_bot.active_chats) - CHAT_LIST_SIZE
+        if not delete_filter and older > 0:
+            print(f"...and {older} older chats, use /delete <name> to find one")
         print("\nEnter the number of chat to delete or /back to return:")
         refresh_needed = False
 
 def delete_message_interface(chat_id):
     """Display interface for deleting messages in a chat"""
     global refresh_needed
-    with console_lock:
-        clear_console()
-        chat = active_chats[chat_id]
+    with screen.frame():
+        chat = current_bot.active_chats[chat_id]
         print(f"╔════════════ DELETE MESSAGES - {chat['name'].upper()} ════════════╗")
         print(f"║ ID: {chat_id}                                                  ║")
         print("║ Type /back to return to chat                                  ║")
         print("║ Type /all to delete all messages                              ║")
         print("║ Type /history to view chat history                            ║")
+        print("║ Type /up and /down to page through messages                   ║")
         print("╚══════════════════════════════════════════════════════════════╝")
         print()
         
@@ -253,23 +1823,73 @@ def delete_message_interface(chat_id):
         print("─" * 80)
         print("No.  Time     Direction  Message")
         print("─" * 80)
-        for i, msg in enumerate(chat['messages'], 1):
-            timestamp = msg['time'].strftime("%H:%M")
-            direction = "Incoming" if msg['direction'] == 'incoming' else "Outgoing"
-            preview = msg['text'][:40] + "..." if msg['type'] == 'text' and len(msg['text']) > 40 else msg['text'] if msg['type'] == 'text' else ""
-            if msg['type'] == 'image':
-                preview = f"[Image: {msg.get('filename', 'photo')}]"
+        offset = page_offset(("dmsg", chat_id), len(chat['messages']))
+        start, page = current_bot.active_chats.page(chat_id, offset)
+        for i, msg in enumerate(page, start + 1):
+            timestamp = msg.time.strftime("%H:%M")
+            direction = "Incoming" if msg.direction == Direction.INCOMING else "Outgoing"
+            preview = message_content(msg)
+            if len(preview) > 40:
+                preview = preview[:40] + "..."
             print(f"{i:<4} {timestamp} {direction:<10} {preview}")
         
         print("─" * 80)
+        print_page_footer(start, len(page), len(chat['messages']))
         print("\nEnter message number to delete, /all to delete all, or /back to return:")
         refresh_needed = False
 
+def parse_search(query):
+    """Split a /search query into (terms, since, until)
+
+    Words and "quoted phrases" become terms. from:YYYY-MM-DD and
+    to:YYYY-MM-DD limit the date range, with the to: day included.
+    """
+    terms, since, until = [], None, None
+    for phrase, word in re.findall(r'"([^"]+)"|(\S+)', query):
+        if word.lower().startswith('from:'):
+            since = datetime.strptime(word[5:], "%Y-%m-%d")
+        elif word.lower().startswith('to:'):
+            until = datetime.fromordinal(datetime.strptime(word[3:], "%Y-%m-%d").toordinal() + 1)
+        elif phrase or word:
+            terms.append(phrase or word)
+    return terms, since, until
+
+def display_search_results(chat_id):
+    """Display the results of the last /search"""
+    global refresh_needed
+    with screen.frame():
+        query, results = last_search
+        chat = current_bot.active_chats.get(chat_id)
+        scope = chat['name'] if chat is not None else "ALL CHATS"
+        print(f"╔════════════════ SEARCH - {scope.upper()} ═════════════════╗")
+        print(f"║ Query: {query:<54}║")
+        print("║ Type /search <words> to search again, /back to return         ║")
+        print("║ Use \"quotes\" for phrases, from:YYYY-MM-DD and to:YYYY-MM-DD   ║")
+        print("╚══════════════════════════════════════════════════════════════╝")
+        print()
+        
+        if not results:
+            print("No matching messages.")
+        else:
+            for result_chat_id, chat_name, msg in results:
+                timestamp = msg.time.strftime("%Y-%m-%d %H:%M")
+                sender = "You" if msg.direction == Direction.OUTGOING else chat_name or result_chat_id
+                content = message_content(msg)
+                if chat_id is None:
+                    print(f"{timestamp} [{result_chat_id}] {sender}: {content}")
+                else:
+                    print(f"{timestamp} {sender}: {content}")
+            if len(results) == SEARCH_LIMIT:
+                print(f"\nShowing the newest {SEARCH_LIMIT} matches, narrow the search to see more")
+        
+        print("─" * 60)
+        print("\nType /back to return:")
+        refresh_needed = False
+
 def settings_interface():
     """Display settings interface"""
     global refresh_needed
-    with console_lock:
-        clear_console()
+    with screen.frame():
         print("╔════════════════════ SETTINGS ═════════════════════╗")
         print("║ Type /back to return to main screen               ║")
         print("║                                                   ║")
@@ -278,6 +1898,7 @@ def settings_interface():
         print("║ 2. Set default timer for messages (seconds)       ║")
         print("║ 3. Enable/disable auto-delete after sending       ║")
         print("║ 4. Enable/disable chat history saving             ║")
+        print("║ 5. Set messages kept in memory per chat           ║")
         print("╚═══════════════════════════════════════════════════╝")
         print()
         
@@ -287,412 +1908,527 @@ def settings_interface():
         print(f"Message Timer: {message_timer.get('text', 0)} seconds")
         print(f"Auto Delete: {'Enabled' if auto_delete else 'Disabled'}")
         print(f"Save History: {'Enabled' if save_history else 'Disabled'}")
+        print(f"Messages In Memory: {live_window_size} per chat")
+        stats = get_queue_stats()
+        print(f"Display Queue: {stats['depth']} pending, "
+              f"{stats['avg_latency'] * 1000:.1f} ms avg / {stats['max_latency'] * 1000:.1f} ms max latency")
         print("─" * 40)
         
         print("\nEnter option number to change or /back to return:")
         refresh_needed = False
 
+def display_bots():
+    """Display the bots this process hosts"""
+    global refresh_needed
+    with screen.frame():
+        print("╔════════════════════ BOTS ════════════════════════╗")
+        print("║ Type /bot <name> to switch to a bot              ║")
+        print("║ Type /back to return to main screen              ║")
+        print("╚══════════════════════════════════════════════════╝")
+        print()
+        
+        print(f"{'':2}{'Name':<20}{'Chats':>8}{'Unread':>8}{'Timers':>8}")
+        print("─" * 50)
+        for name, instance in bots.items():
+            marker = "*" if instance is current_bot else ""
+            print(f"{marker:<2}{name:<20}{len(instance.active_chats):>8}{instance.unread():>8}"
+                  f"{len(instance.deletion_scheduler):>8}")
+        print("─" * 50)
+        
+        print("\nType /bot <name> or /back to return:")
+        refresh_needed = False
+
+def format_seconds(seconds):
+    """Format a latency for the stats screen"""
+    if seconds == float('inf'):
+        return f">{LATENCY_BUCKETS[-1]:g} s"
+    return f"{seconds * 1000:.0f} ms" if seconds < 1 else f"{seconds:.1f} s"
+
+def display_stats():
+    """Display throughput and latency counters"""
+    global refresh_needed
+    with screen.frame():
+        print("╔════════════════════ STATS ═══════════════════════╗")
+        print("║ Type /back to return to main screen              ║")
+        print("║ Type /refresh to update the numbers              ║")
+        print("╚══════════════════════════════════════════════════╝")
+        print()
+        
+        handled = updates_handled.snapshot()
+        kinds = ", ".join(f"{count} {kind}" for (kind,), count in sorted(handled.items()))
+        print(f"Updates handled: {sum(handled.values())}" + (f" ({kinds})" if kinds else ""))
+        series = handler_seconds.snapshot().get(())
+        if series:
+            print(f"Handler latency: {format_seconds(series[2] / series[1])} avg, "
+                  f"p95 under {format_seconds(handler_seconds.quantile(series, 0.95))}")
+        series = download_seconds.snapshot().get(())
+        if series:
+            print(f"Media downloads: {series[1]}, {download_bytes.total() // 1024} KB, "
+                  f"{format_seconds(series[2] / series[1])} avg")
+        stats = get_queue_stats()
+        print(f"Display Queue: {stats['depth']} pending, "
+              f"{stats['avg_latency'] * 1000:.1f} ms avg / {stats['max_latency'] * 1000:.1f} ms max latency")
+        print(f"Pending Deletions: {len(current_bot.deletion_scheduler)}")
+        errors = errors_logged.snapshot()
+        if errors:
+            print("Errors: " + ", ".join(f"{source} {count}" for (source,), count in sorted(errors.items())))
+        
+        responses = api_responses.snapshot()
+        latencies = api_request_seconds.snapshot()
+        if latencies:
+            print("\nBot API requests:")
+            print("─" * 70)
+            print(f"{'Method':<20}{'Count':>7}{'Avg':>10}{'p95 under':>12}  Statuses")
+            for (method,), series in sorted(latencies.items()):
+                statuses = " ".join(f"{status}×{count}" for (name, status), count in sorted(responses.items())
+                                    if name == method)
+                print(f"{method:<20}{series[1]:>7}{format_seconds(series[2] / series[1]):>10}"
+                      f"{format_seconds(api_request_seconds.quantile(series, 0.95)):>12}  {statuses}")
+            print("─" * 70)
+        
+        if metrics_server is not None:
+            print(f"\nMetrics endpoint: http://{metrics_server.host}:{metrics_server.port}/metrics")
+        print("\nType /back to return:")
+        refresh_needed = False
+
+async def fetch_media(api, media, attachment, local_path):
+    """Stream an attachment to a temporary file, then move it into place"""
+    global download_slots
+    if download_slots is None:
+        download_slots = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+    
+    # Worker processes share the directory and may fetch the same file at once
+    temp_path = f"{local_path}.{os.getpid()}.part"
+    try:
+        async with download_slots:
+            started = time.perf_counter()
+            size = await api.adownload(attachment.file_id, temp_path, media.max_download)
+            download_seconds.observe(time.perf_counter() - started)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    download_bytes.inc(size)
+    os.replace(temp_path, local_path)  # Readers never see a half-written file
+
+async def download_media(api, media, attachment):
+    """Return the local path of an attachment, downloading it only if not stored yet"""
+    local_path = os.path.join(media.directory, media.filename(attachment))
+    if os.path.exists(local_path):
+        return local_path
+    if (attachment.file_size or 0) > media.max_download:
+        raise MediaTooLarge(f"{format_size(attachment.file_size)} is over the "
+                            f"{format_size(media.max_download)} download limit")
+    
+    # Share one download between messages carrying the same file
+    task = downloads_in_flight.get(attachment.file_unique_id)
+    if task is None:
+        task = asyncio.ensure_future(fetch_media(api, media, attachment, local_path))
+        downloads_in_flight[attachment.file_unique_id] = task
+        task.add_done_callback(lambda _: downloads_in_flight.pop(attachment.file_unique_id, None))
+    await asyncio.shield(task)
+    return local_path
+
+async def receive_media(instance, chat_id, message_data, media, attachment):
+    """Download an incoming attachment and announce it once it is saved"""
+    try:
+        local_path = await download_media(instance.api, media, attachment)
+    except MediaTooLarge as e:
+        print(f"{media.label} from chat {chat_id} not downloaded: {e}")
+        return
+    except Exception as e:
+        errors_logged.inc(source="download")
+        print(f"Error downloading {media.label.lower()} from chat {chat_id}: {e}")
+        return
+    
+    message_data.local_path = local_path
+    if save_history:
+        instance.history_store.set_local_path(chat_id, message_data.message_id, local_path)
+    
+    # Add to message queue for display
+    chat = instance.active_chats.get(chat_id)
+    enqueue_display({
+        'type': 'media',
+        'kind': media.kind,
+        'bot': instance.name,
+        'chat_id': chat_id,
+        'name': chat['name'] if chat is not None else chat_id,
+        'time': message_data.time,
+        'filename': message_data.filename,
+        'local_path': local_path
+    })
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle incoming messages"""
+    """Handle incoming messages, timing each one"""
+    started = time.perf_counter()
+    try:
+        await receive_message(context.bot_data['instance'], update, context)
+    finally:
+        handler_seconds.observe(time.perf_counter() - started)
+        media, _ = media_of(update.message)
+        updates_handled.inc(kind=media.attribute if media is not None else "text")
+
+async def route_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Pass an update to the worker process that owns its chat
+
+    A chat always maps to the same worker, and each worker handles its
+    updates in order, so messages from one chat are never reordered.
+    """
+    shard = update.message.chat.id % len(shard_queues)
+    shard_queues[shard].put((context.bot_data['instance'].name, update.to_dict()))
+    updates_routed.inc(shard=str(shard))
+
+async def receive_message(instance, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Record a message to one of the bots, show it and send any auto-reply"""
     user = update.message.from_user
     chat_id = update.message.chat.id
     text = update.message.text.strip().lower() if update.message.text else ""
     timestamp = datetime.now()
     
     # Initialize chat if not exists
-    if chat_id not in active_chats:
-        active_chats[chat_id] = {
-            'name': user.first_name + (f" {user.last_name}" if user.last_name else ""),
-            'username': user.username,
-            'messages': []
-        }
+    name = user.first_name + (f" {user.last_name}" if user.last_name else "")
+    chat, created = instance.active_chats.add_chat(chat_id, name, user.username)
+    if created and save_history:
+        instance.history_store.save_chat(chat_id, name, user.username)
+    
+    # A reply means everything we sent before it has been seen
+    mark_outgoing_seen(instance, chat_id, update.message.message_id)
     
     # Create message data
-    message_data = {
-        'time': timestamp,
-        'direction': 'incoming'
-    }
+    message_data = Message(update.message.message_id, Direction.INCOMING, MessageType.TEXT,
+                           ts=timestamp.timestamp())
     
-    # Check if message contains photo
-    if update.message.photo:
-        # Get the highest resolution photo
-        photo = update.message.photo[-1]
-        file_id = photo.file_id
-        
-        # Download the photo
-        file = await context.bot.get_file(file_id)
-        file_path = file.file_path
-        
-        # Create images directory if it doesn't exist
-        os.makedirs("downloaded_images", exist_ok=True)
-        
-        # Generate filename
-        filename = f"image_{chat_id}_{int(time.time())}.jpg"
-        local_path = os.path.join("downloaded_images", filename)
-        
-        # Download the file
-        await file.download_to_drive(local_path)
-        
-        # Add image data to message
-        message_data.update({
-            'type': 'image',
-            'filename': filename,
-            'local_path': local_path
-        })
-        
+    # Check if message carries an attachment; identical files share a file name
+    media, attachment = media_of(update.message)
+    if media is not None:
+        message_data.kind = media.kind
+        message_data.filename = media.filename(attachment)
+        message_data.text = update.message.caption
     else:
         # Add text data to message
-        message_data.update({
-            'type': 'text',
-            'text': update.message.text
-        })
-    
-    # Add to chat history
-    active_chats[chat_id]['messages'].append(message_data)
+        message_data.text = update.message.text
     
-    # Save to permanent history if enabled
-    if save_history:
-        if chat_id not in chat_history:
-            chat_history[chat_id] = []
-        chat_history[chat_id].append(message_data)
-    
-    # Add to message queue for display
-    queue_data = {
-        'type': 'image' if update.message.photo else 'message',
-        'chat_id': chat_id,
-        'name': active_chats[chat_id]['name'],
-        'time': timestamp
-    }
+    # Add to chat history, counted as unread
+    record_message(instance, chat_id, message_data)
     
-    if update.message.photo:
-        queue_data['filename'] = filename
-        queue_data['local_path'] = local_path
+    if media is not None:
+        # Download in the background so this update's handler is not held
+        # up; the notification is shown once the file is saved
+        context.application.create_task(receive_media(instance, chat_id, message_data, media, attachment))
     else:
-        queue_data['text'] = update.message.text
-    
-    message_queue.append(queue_data)
+        # Add to message queue for display
+        enqueue_display({
+            'type': 'message',
+            'bot': instance.name,
+            'chat_id': chat_id,
+            'name': chat['name'],
+            'time': timestamp,
+            'text': update.message.text
+        })
 
     # --- Auto-reply section ---
-    auto_replies = {
-        "hi": "Hello! 👋",
-        "hello": "Hi there!",
-        "how are you": "I'm doing great, thanks for asking! How about you?",
-        "bye": "Goodbye! 👋",
-        "thanks": "You're welcome! 😊"
-    }
+    reply = instance.auto_replies.match(chat_id, text)
+    if reply:
+        # Send in the background: a send can wait on the flood limits or a
+        # 429, and updates are handled one at a time
+        context.application.create_task(send_auto_reply(instance, chat_id, reply))
 
-    for trigger, reply in auto_replies.items():
-        if trigger in text:
-            # Send reply using bot API
-            url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-            data = {'chat_id': chat_id, 'text': reply}
-            response = requests.post(url, data=data)
-
-            if response.status_code == 200:
-                # Create reply message data
-                reply_data = {
-                    'type': 'text',
-                    'text': reply,
-                    'time': datetime.now(),
-                    'direction': 'outgoing'
-                }
-                
-                # Add to chat history
-                active_chats[chat_id]['messages'].append(reply_data)
-                
-                # Save to permanent history if enabled
-                if save_history:
-                    if chat_id not in chat_history:
-                        chat_history[chat_id] = []
-                    chat_history[chat_id].append(reply_data)
-                
-                # Add to message queue for display
-                message_queue.append({
-                    'type': 'message',
-                    'chat_id': chat_id,
-                    'text': reply,
-                    'name': "You",
-                    'time': datetime.now()
-                })
-            break  # stop after first match
-
-def send_message_with_timer(chat_id, text, is_image=False):
-    """Send message with timer option and return message info"""
+async def send_auto_reply(instance, chat_id, reply):
+    """Send an auto-reply and add it to the chat's history"""
     try:
-        if is_image:
-            # Send image
-            with open(text, 'rb') as f:
-                photo_data = f.read()
-            
-            url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendPhoto"
-            files = {'photo': (os.path.basename(text), BytesIO(photo_data))}
-            data = {'chat_id': chat_id, 'caption': '📸 Photo'}
+        response = await instance.api.acall('sendMessage', data={'chat_id': chat_id, 'text': reply})
+    except Exception as e:
+        errors_logged.inc(source="send")
+        print(f"Error sending auto-reply to chat {chat_id}: {e}")
+        return
+    
+    if response.status_code == 200:
+        # Create reply message data
+        reply_data = Message(response.json()['result']['message_id'], Direction.OUTGOING,
+                             MessageType.TEXT, text=reply)
+        
+        # Add to chat history
+        record_message(instance, chat_id, reply_data)
+        
+        # Add to message queue for display
+        enqueue_display({
+            'type': 'message',
+            'bot': instance.name,
+            'chat_id': chat_id,
+            'text': reply,
+            'name': "You",
+            'time': datetime.now()
+        })
+
+def post_message(instance, chat_id, text, kind=MessageType.TEXT, file_id=None, progress=None):
+    """Send a text or file from a bot to one chat and add it to the chat's history
+
+    For any kind in MEDIA_TYPES, text is the file's path and file_id skips
+    the lookup of an earlier upload. Returns (True, message_id) or (False,
+    error description).
+    """
+    try:
+        media = MEDIA_TYPES.get(kind)
+        if media is not None:
+            # Send the file, reusing the file_id if this exact file was uploaded before
+            data = {'chat_id': chat_id}
+            if media.caption:
+                data['caption'] = media.caption
+            # A file_id passed in is trusted, so a failed send is not retried as an upload
+            stored_file_id = file_id is None
+            if stored_file_id:
+                file_id = instance.history_store.get_file_id(text)
+            response = None
+            if file_id:
+                response = instance.api.call(media.send_method, data=dict(data, **{media.attribute: file_id}))
             
-            response = requests.post(url, files=files, data=data)
-            response_data = response.json()
+            if response is None or (response.status_code != 200 and stored_file_id):
+                size = os.path.getsize(text)
+                if size > media.max_upload:
+                    return False, (f"{media.label} is {format_size(size)}, over the "
+                                   f"{format_size(media.max_upload)} upload limit")
+                # Stream the file from disk rather than reading it into memory
+                upload = MultipartUpload(data, media.attribute, text, progress=progress)
+                response = instance.api.call(media.send_method, upload=upload)
+                if response.status_code == 200:
+                    # The message is sent either way, without a file_id the next send uploads again
+                    uploaded_file_id = media.sent_file_id(response.json()['result'])
+                    if uploaded_file_id:
+                        instance.history_store.save_file_id(text, uploaded_file_id)
             
-            if response.status_code == 200:
-                message_id = response_data['result']['message_id']
-                # Create message data
-                message_data = {
-                    'type': 'image',
-                    'filename': os.path.basename(text),
-                    'time': datetime.now(),
-                    'direction': 'outgoing',
-                    'message_id': message_id,
-                    'seen': False
-                }
-                
-                # Add to chat history
-                active_chats[chat_id]['messages'].append(message_data)
-                
-                # Save to permanent history if enabled
-                if save_history:
-                    if chat_id not in chat_history:
-                        chat_history[chat_id] = []
-                    chat_history[chat_id].append(message_data)
-                
-                return True, message_id
+            # Create message data
+            message_data = Message(None, Direction.OUTGOING, kind, filename=os.path.basename(text))
         else:
             # Send text message
-            url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
             data = {'chat_id': chat_id, 'text': text}
+            response = instance.api.call('sendMessage', data=data)
             
-            response = requests.post(url, data=data)
-            response_data = response.json()
-            
-            if response.status_code == 200:
-                message_id = response_data['result']['message_id']
-                # Create message data
-                message_data = {
-                    'type': 'text',
-                    'text': text,
-                    'time': datetime.now(),
-                    'direction': 'outgoing',
-                    'message_id': message_id,
-                    'seen': False
-                }
-                
-                # Add to chat history
-                active_chats[chat_id]['messages'].append(message_data)
-                
-                # Save to permanent history if enabled
-                if save_history:
-                    if chat_id not in chat_history:
-                        chat_history[chat_id] = []
-                    chat_history[chat_id].append(message_data)
-                
-                return True, message_id
+            # Create message data
+            message_data = Message(None, Direction.OUTGOING, MessageType.TEXT, text=text)
         
-        return False, None
+        response_data = response.json()
+        if response.status_code != 200:
+            return False, response_data.get('description', f"HTTP {response.status_code}")
+        
+        message_data.message_id = response_data['result']['message_id']
         
+        # Add to chat history
+        record_message(instance, chat_id, message_data)
+        
+        return True, message_data.message_id
+    
     except Exception as e:
-        print(f"Error sending message: {e}")
+        errors_logged.inc(source="send")
+        return False, str(e)
+
+def send_message_with_timer(instance, chat_id, text, kind=MessageType.TEXT, progress=None):
+    """Send message with timer option and return message info"""
+    success, result = post_message(instance, chat_id, text, kind=kind, progress=progress)
+    if not success:
+        print(f"Error sending message: {result}")
         return False, None
+    return True, result
 
-def delete_message_from_server(message_id, chat_id):
-    """Delete message from Telegram server"""
-    try:
-        url = f"https://api.telegram.org/bot{BOT_TOKEN}/deleteMessage"
-        data = {'chat_id': chat_id, 'message_id': message_id}
-        response = requests.post(url, data=data)
-        return response.status_code == 200
-    except:
-        return False
+def broadcast(instance, chat_ids, text, kind=MessageType.TEXT, progress=None):
+    """Send the same text or file from a bot to many of its chats at once
+
+    Sends run on BROADCAST_WORKERS threads and are paced by the API client's
+    rate limits. A file is uploaded once and every other chat gets its
+    file_id, unless Telegram returned none to reuse, in which case each
+    chat gets its own upload. progress(done, total) is called after each
+    chat. Returns {chat_id: (success, message_id or error description)}.
+    """
+    chat_ids = list(dict.fromkeys(chat_ids))
+    results = {}
+    file_id = None
+    
+    if kind in MEDIA_TYPES and chat_ids:
+        # Send to the first chat on its own: post_message re-uploads the file
+        # if a stored file_id is rejected, then the rest reuse the one that worked
+        first = chat_ids.pop(0)
+        results[first] = post_message(instance, first, text, kind)
+        if progress:
+            progress(1, len(chat_ids) + 1)
+        success, error = results[first]
+        if success:
+            try:
+                file_id = instance.history_store.get_file_id(text)
+            except OSError as e:  # The file went away since
+                success, error = False, str(e)
+        if not success:
+            for chat_id in chat_ids:
+                results[chat_id] = (False, error)
+            return results
+    
+    total = len(results) + len(chat_ids)
+    with ThreadPoolExecutor(max_workers=BROADCAST_WORKERS) as pool:
+        futures = {pool.submit(post_message, instance, chat_id, text, kind, file_id): chat_id
+                   for chat_id in chat_ids}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            if progress:
+                progress(len(results), total)
+    
+    return results
 
-def check_message_views(chat_id, message_id):
-    """Check if a message has been viewed"""
+def print_broadcast_progress(done, total):
+    """Show broadcast progress on a single console line"""
+    print(f"\rBroadcasting... {done} of {total} chats", end="\n" if done >= total else "", flush=True)
+
+def delete_message_from_server(instance, message_id, chat_id):
+    """Delete message from Telegram server
+
+    Returns False only if the deletion failed in a way worth retrying later,
+    such as a network error or Telegram being overloaded. A message that is
+    already gone or too old to delete counts as done.
+    """
     try:
-        # This is a simplified approach - actual implementation may vary
-        # based on Telegram API limitations for checking message views
-        
-        # For now, we'll use a placeholder that randomly returns True/False
-        # In a real implementation, you might need to use message updates
-        # or other Telegram API methods
-        return random.choice([True, False])  # Placeholder
-        
-    except Exception as e:
-        print(f"Error checking message views: {e}")
+        data = {'chat_id': chat_id, 'message_id': message_id}
+        response = instance.api.call('deleteMessage', data=data)
+    except requests.RequestException as e:
+        errors_logged.inc(source="delete")
+        print(f"Error deleting message {message_id}: {e}")
         return False
+    return response.status_code != 429 and response.status_code < 500
 
-def check_seen_status():
-    """Background thread to check if messages have been seen"""
+def process_deletions(instance):
+    """Process a bot's scheduled message deletions as they come due"""
+    retries = {}  # (chat_id, message_id) -> failed attempts so far
     while True:
-        for chat_id, chat in active_chats.items():
-            for msg in chat['messages']:
-                if msg['direction'] == 'outgoing' and not msg.get('seen', False) and msg.get('message_id'):
-                    # Check if this message has been seen
-                    if check_message_views(chat_id, msg.get('message_id')):
-                        msg['seen'] = True
-                        global refresh_needed
-                        refresh_needed = True
-        
-        time.sleep(10)  # Check every 10 seconds
-
-def process_deletions():
-    """Process scheduled message deletions"""
-    while True:
-        current_time = time.time()
-        to_remove = []
-        
-        for i, deletion in enumerate(pending_deletions):
-            if current_time >= deletion['delete_time']:
-                # Try to delete from server
-                if deletion.get('message_id'):
-                    delete_message_from_server(deletion['message_id'], deletion['chat_id'])
-                
-                # Delete from local history
-                chat_id = deletion['chat_id']
-                if chat_id in active_chats:
-                    for msg in active_chats[chat_id]['messages']:
-                        if (msg['direction'] == 'outgoing' and 
-                            msg['type'] == deletion['message_type'] and
-                            msg.get('filename') == deletion.get('filename')):
-                            active_chats[chat_id]['messages'].remove(msg)
-                            break
-                
-                to_remove.append(i)
-                global refresh_needed
-                refresh_needed = True
-                print(f"Message deleted from chat {chat_id}")
+        chat_id, message_id = instance.deletion_scheduler.wait_next()
+        
+        # Delete from local history
+        if instance.active_chats.pop_message(chat_id, message_id) is not None:
+            request_refresh()
         
-        # Remove processed deletions
-        for i in sorted(to_remove, reverse=True):
-            if i < len(pending_deletions):
-                pending_deletions.pop(i)
+        # Try to delete from server, keeping the stored deletion until it succeeds
+        if not delete_message_from_server(instance, message_id, chat_id):
+            attempt = retries.get((chat_id, message_id), 0)
+            retries[(chat_id, message_id)] = attempt + 1
+            delete_time = time.time() + min(API_RETRY_BASE_DELAY * 2 ** attempt, DELETION_RETRY_MAX_DELAY)
+            instance.history_store.save_deletion(chat_id, message_id, delete_time)
+            instance.deletion_scheduler.schedule(chat_id, message_id, delete_time)
+            continue
         
-        time.sleep(1)  # Check every second
+        retries.pop((chat_id, message_id), None)
+        instance.history_store.remove_deletion(chat_id, message_id)
+        print(f"Message deleted from chat {chat_id}")
 
-def process_message_queue():
-    """Process and display incoming messages"""
-    global refresh_needed, current_display
+NOTIFICATION_PROMPTS = {  # Screen -> prompt reprinted under a notification
+    "main": "Enter chat ID to reply or command:",
+    "find": "Enter chat ID to reply or command:",
+    "ids": "Type /back to return:",
+    "stats": "Type /back to return:",
+    "bots": "Type /back to return:",
+    "delete": "Enter the number of chat to delete or /back to return:",
+    "settings": "Enter option number to change or /back to return:",
+    "dmsg": "Enter message number to delete, /all to delete all, or /back to return:",
+    "history": "Type /back to return to chat:",
+}
+BRIEF_NOTIFICATION_SCREENS = ("ids", "stats", "bots", "delete", "settings", "dmsg", "history")  # Show IDs only
+
+def display_notification(msg):
+    """Print a notification for a queued message on the current screen"""
+    global refresh_needed
+    
+    timestamp = msg['time'].strftime("%H:%M:%S")
+    media = MEDIA_TYPES[msg['kind']] if msg['type'] == 'media' else None
+    
+    if msg['bot'] != current_bot.name:
+        # A chat of another bot, so only say where it is; /bot <name> switches over
+        kind = media.label.lower() if media is not None else "message"
+        print(f"\n[{timestamp}] New {kind} for bot {msg['bot']} from {msg['name']} (ID: {msg['chat_id']})")
+        return
+    
+    if current_display == msg['chat_id']:
+        # Message is from the current chat, the redraw adds it to the conversation
+        refresh_needed = True
+        if media is not None and media.preview:
+            display_image_notification(msg['local_path'], msg['name'])
+        return
     
+    screen_name = current_display[0] if isinstance(current_display, tuple) else current_display
+    if screen_name in BRIEF_NOTIFICATION_SCREENS:
+        sender = f"ID: {msg['chat_id']}"
+    else:
+        sender = f"{msg['name']} (ID: {msg['chat_id']})"
+    
+    if media is None:
+        print(f"\n[{timestamp}] New message from {sender}:")
+        print(f"→ {msg['text']}")
+    else:
+        print(f"\n[{timestamp}] {media.icon} New {media.label.lower()} from {sender}")
+        print(f"→ {media.label} saved as: {msg['filename']}")
+        if media.preview:
+            display_image_notification(msg['local_path'], sender)
+    print("\n" + NOTIFICATION_PROMPTS.get(screen_name, "Type your message or command:"))
+
+def refresh_display():
+    """Redraw whichever screen is currently displayed"""
+    if current_display == "main":
+        display_main_interface()
+    elif current_display == "ids":
+        display_ids_only()
+    elif current_display == "delete":
+        delete_chat_interface()
+    elif current_display == "settings":
+        settings_interface()
+    elif current_display == "stats":
+        display_stats()
+    elif current_display == "bots":
+        display_bots()
+    elif isinstance(current_display, tuple) and current_display[0] == "find":
+        display_find_results(current_display[1])
+    elif isinstance(current_display, tuple) and current_display[0] == "dmsg":
+        delete_message_interface(current_display[1])
+    elif isinstance(current_display, tuple) and current_display[0] == "history":
+        display_chat_history(current_display[1])
+    elif isinstance(current_display, tuple) and current_display[0] == "search":
+        display_search_results(current_display[1])
+    else:
+        display_chat_interface(current_display)
+
+def process_message_queue():
+    """Display queued notifications as soon as they arrive"""
+    last_redraw = 0.0
     while True:
-        if message_queue:
-            with console_lock:
-                msg = message_queue.pop(0)
-                timestamp = msg['time'].strftime("%H:%M:%S")
-                
-                if msg['type'] == 'message':
-                    if current_display == "main":
-                        # Show notification on main screen
-                        print(f"\n[{timestamp}] New message from {msg['name']} (ID: {msg['chat_id']}):")
-                        print(f"→ {msg['text']}")
-                        print("\nEnter chat ID to reply or command:")
-                    elif current_display == "ids":
-                        # Show notification on IDs screen
-                        print(f"\n[{timestamp}] New message from ID: {msg['chat_id']}:")
-                        print(f"→ {msg['text']}")
-                        print("\nType /back to return:")
-                    elif current_display == "delete":
-                        # Show notification on delete screen
-                        print(f"\n[{timestamp}] New message from ID: {msg['chat_id']}:")
-                        print(f"→ {msg['text']}")
-                        print("\nEnter the number of chat to delete or /back to return:")
-                    elif current_display == "settings":
-                        # Show notification on settings screen
-                        print(f"\n[{timestamp}] New message from ID: {msg['chat_id']}:")
-                        print(f"→ {msg['text']}")
-                        print("\nEnter option number to change or /back to return:")
-                    elif isinstance(current_display, tuple) and current_display[0] == "dmsg":
-                        # Show notification on delete message screen
-                        print(f"\n[{timestamp}] New message from ID: {msg['chat_id']}:")
-                        print(f"→ {msg['text']}")
-                        print("\nEnter message number to delete, /all to delete all, or /back to return:")
-                    elif isinstance(current_display, tuple) and current_display[0] == "history":
-                        # Show notification on history screen
-                        print(f"\n[{timestamp}] New message from ID: {msg['chat_id']}:")
-                        print(f"→ {msg['text']}")
-                        print("\nType /back to return to chat:")
-                    else:
-                        # If we're in a chat, show notification even if it's from another user
-                        if current_display == msg['chat_id']:
-                            # Message is from current chat
-                            refresh_needed = True
-                            print(f"\n[{timestamp}] New message from {msg['name']}:")
-                            print(f"→ {msg['text']}")
-                            print("\nType your message or command:")
-                        else:
-                            # Message is from another user
-                            print(f"\n[{timestamp}] New message from {msg['name']} (ID: {msg['chat_id']}):")
-                            print(f"→ {msg['text']}")
-                            print("\nType your message or command:")
-                
-                elif msg['type'] == 'image':
-                    if current_display == "main":
-                        # Show image notification on main screen
-                        print(f"\n[{timestamp}] 📸 New image from {msg['name']} (ID: {msg['chat_id']})")
-                        print(f"→ Image saved as: {msg['filename']}")
-                        display_image_notification(msg['local_path'], msg['name'])
-                        print("\nEnter chat ID to reply or command:")
-                    elif current_display == "ids":
-                        # Show image notification on IDs screen
-                        print(f"\n[{timestamp}] 📸 New image from ID: {msg['chat_id']}")
-                        print(f"→ Image saved as: {msg['filename']}")
-                        display_image_notification(msg['local_path'], f"ID: {msg['chat_id']}")
-                        print("\nType /back to return:")
-                    elif current_display == "delete":
-                        # Show image notification on delete screen
-                        print(f"\n[{timestamp}] 📸 New image from ID: {msg['chat_id']}")
-                        print(f"→ Image saved as: {msg['filename']}")
-                        display_image_notification(msg['local_path'], f"ID: {msg['chat_id']}")
-                        print("\nEnter the number of chat to delete or /back to return:")
-                    elif current_display == "settings":
-                        # Show image notification on settings screen
-                        print(f"\n[{timestamp}] 📸 New image from ID: {msg['chat_id']}")
-                        print(f"→ Image saved as: {msg['filename']}")
-                        display_image_notification(msg['local_path'], f"ID: {msg['chat_id']}")
-                        print("\nEnter option number to change or /back to return:")
-                    elif isinstance(current_display, tuple) and current_display[0] == "dmsg":
-                        # Show image notification on delete message screen
-                        print(f"\n[{timestamp}] 📸 New image from ID: {msg['chat_id']}")
-                        print(f"→ Image saved as: {msg['filename']}")
-                        display_image_notification(msg['local_path'], f"ID: {msg['chat_id']}")
-                        print("\nEnter message number to delete, /all to delete all, or /back to return:")
-                    elif isinstance(current_display, tuple) and current_display[0] == "history":
-                        # Show image notification on history screen
-                        print(f"\n[{timestamp}] 📸 New image from ID: {msg['chat_id']}")
-                        print(f"→ Image saved as: {msg['filename']}")
-                        display_image_notification(msg['local_path'], f"ID: {msg['chat_id']}")
-                        print("\nType /back to return to chat:")
-                    else:
-                        # If we're in a chat, show image notification
-                        if current_display == msg['chat_id']:
-                            # Image is from current chat
-                            refresh_needed = True
-                            print(f"\n[{timestamp}] 📸 New image from {msg['name']}:")
-                            print(f"→ Image saved as: {msg['filename']}")
-                            display_image_notification(msg['local_path'], msg['name'])
-                            print("\nType your message or command:")
-                        else:
-                            # Image is from another user
-                            print(f"\n[{timestamp}] 📸 New image from {msg['name']} (ID: {msg['chat_id']}):")
-                            print(f"→ Image saved as: {msg['filename']}")
-                            display_image_notification(msg['local_path'], msg['name'])
-                            print("\nType your message or command:")
+        # Block until something is queued, then take everything that piled up
+        # behind it (e.g. while the last redraw ran) so a burst gets one redraw
+        batch = [message_queue.get()]
+        
+        # Cap redraws at RENDER_MAX_FPS, anything queued while waiting joins this batch
+        wait = last_redraw + 1 / RENDER_MAX_FPS - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        while True:
+            try:
+                batch.append(message_queue.get_nowait())
+            except queue.Empty:
+                break
+        
+        with console_lock:
+            for msg in batch:
+                if msg['type'] != 'refresh':
+                    display_notification(msg)
         
         # Check if we need to refresh the display
         if refresh_needed:
-            if current_display == "main":
-                display_main_interface()
-            elif current_display == "ids":
-                display_ids_only()
-            elif current_display == "delete":
-                delete_chat_interface()
-            elif current_display == "settings":
-                settings_interface()
-            elif isinstance(current_display, tuple) and current_display[0] == "dmsg":
-                delete_message_interface(current_display[1])
-            elif isinstance(current_display, tuple) and current_display[0] == "history":
-                display_chat_history(current_display[1])
-            else:
-                display_chat_interface(current_display)
+            refresh_display()
+            last_redraw = time.monotonic()
         
-        time.sleep(0.5)  # Check for new messages every 0.5 seconds
+        now = time.monotonic()
+        for msg in batch:
+            latency = now - msg['enqueued_at']
+            display_latency.observe(latency)
+            queue_stats['rendered'] += 1
+            queue_stats['total_latency'] += latency
+            queue_stats['last_latency'] = latency
+            queue_stats['max_latency'] = max(queue_stats['max_latency'], latency)
 
-def console_interface(app: Application):
+def console_interface():
     """Handle console input for replying to messages"""
-    global current_display, refresh_needed, message_timer, auto_delete, save_history
+    global current_display, refresh_needed, message_timer, auto_delete, save_history, last_search
+    global live_window_size, delete_filter, current_bot
     
     time.sleep(1)  # Wait for bot to initialize
     
@@ -703,93 +2439,95 @@ def console_interface(app: Application):
         try:
             # Check if we need to refresh due to new messages
             if refresh_needed:
-                if current_display == "main":
-                    display_main_interface()
-                elif current_display == "ids":
-                    display_ids_only()
-                elif current_display == "delete":
-                    delete_chat_interface()
-                elif current_display == "settings":
-                    settings_interface()
-                elif isinstance(current_display, tuple) and current_display[0] == "dmsg":
-                    delete_message_interface(current_display[1])
-                elif isinstance(current_display, tuple) and current_display[0] == "history":
-                    display_chat_history(current_display[1])
-                else:
-                    display_chat_interface(current_display)
+                refresh_display()
             
             user_input = input().strip()
             
             if user_input.lower() == '/exit':
                 print("Goodbye!")
-                # Save chat history before exiting
-                if save_history:
-                    try:
-                        with open("chat_history.pkl", "wb") as f:
-                            pickle.dump(chat_history, f)
-                        print("Chat history saved successfully")
-                    except Exception as e:
-                        print(f"Error saving chat history: {e}")
+                # Commit any history writes still queued before exiting
+                for instance in bots.values():
+                    instance.history_store.close()
                 os._exit(0)
                 
             elif user_input.lower() == '/refresh':
-                if current_display == "main":
-                    display_main_interface()
-                elif current_display == "ids":
-                    display_ids_only()
-                elif current_display == "delete":
-                    delete_chat_interface()
-                elif current_display == "settings":
-                    settings_interface()
-                elif isinstance(current_display, tuple) and current_display[0] == "dmsg":
-                    delete_message_interface(current_display[1])
-                elif isinstance(current_display, tuple) and current_display[0] == "history":
-                    display_chat_history(current_display[1])
-                else:
-                    display_chat_interface(current_display)
+                refresh_display()
                 continue
                 
             elif user_input.lower() == '/clear':
                 clear_console()
-                if current_display == "main":
-                    display_main_interface()
-                elif current_display == "ids":
-                    display_ids_only()
-                elif current_display == "delete":
-                    delete_chat_interface()
-                elif current_display == "settings":
-                    settings_interface()
-                elif isinstance(current_display, tuple) and current_display[0] == "dmsg":
-                    delete_message_interface(current_display[1])
-                elif isinstance(current_display, tuple) and current_display[0] == "history":
-                    display_chat_history(current_display[1])
-                else:
-                    display_chat_interface(current_display)
+                refresh_display()
                 continue
                 
             elif user_input.lower() == '/back':
+                view_offsets.clear()
                 if current_display != "main":
                     display_main_interface()
                     current_display = "main"
                 continue
+            
+            elif user_input.lower() in ('/up', '/down') and (
+                    isinstance(current_display, int) or
+                    (isinstance(current_display, tuple) and current_display[0] in ("history", "dmsg"))):
+                # Page through the messages on screen; the view clamps the offset
+                step = PAGE_SIZE if user_input.lower() == '/up' else -PAGE_SIZE
+                view_offsets[current_display] = view_offsets.get(current_display, 0) + step
+                refresh_display()
+                continue
                 
             elif user_input.lower() == '/ids':
                 display_ids_only()
                 current_display = "ids"
                 continue
                 
-            elif user_input.lower() == '/delete':
+            elif user_input.lower() == '/delete' or user_input.lower().startswith('/delete '):
+                delete_filter = user_input[7:].strip() or None
                 delete_chat_interface()
                 current_display = "delete"
                 continue
+            
+            elif user_input.lower().startswith('/find'):
+                prefix = user_input[5:].strip()
+                if not prefix:
+                    print("Usage: /find <name or @username>")
+                    time.sleep(1)
+                    continue
+                display_find_results(prefix)
+                current_display = ("find", prefix)
+                continue
                 
+            elif user_input.lower() == '/stats':
+                display_stats()
+                current_display = "stats"
+                continue
+            
+            elif user_input.lower() == '/bots':
+                display_bots()
+                current_display = "bots"
+                continue
+            
+            elif user_input.lower().startswith('/bot '):
+                name = user_input[5:].strip()
+                if name not in bots:
+                    print(f"Unknown bot. Bots: {', '.join(bots)}")
+                    time.sleep(1)
+                    refresh_display()
+                    continue
+                # Chat ids and scroll positions belong to the bot being left
+                current_bot = bots[name]
+                view_offsets.clear()
+                delete_choices.clear()
+                display_main_interface()
+                current_display = "main"
+                continue
+            
             elif user_input.lower() == '/settings':
                 settings_interface()
                 current_display = "settings"
                 continue
                 
             elif user_input.lower() == '/dmsg':
-                if isinstance(current_display, int) and current_display in active_chats:
+                if isinstance(current_display, int) and current_display in current_bot.active_chats:
                     delete_message_interface(current_display)
                     current_display = ("dmsg", current_display)
                 else:
@@ -804,7 +2542,7 @@ def console_interface(app: Application):
                     print("Please enter a chat first to view history.")
                     time.sleep(1)
                     display_main_interface()
-                elif isinstance(current_display, int) and current_display in active_chats:
+                elif isinstance(current_display, int) and current_display in current_bot.active_chats:
                     display_chat_history(current_display)
                     current_display = ("history", current_display)
                 else:
@@ -814,6 +2552,88 @@ def console_interface(app: Application):
                         display_main_interface()
                 continue
                 
+            elif user_input.lower().startswith('/search'):
+                # Search the open chat (or the chat being searched), otherwise every chat
+                if isinstance(current_display, int):
+                    scope = current_display
+                elif isinstance(current_display, tuple) and current_display[0] in ("history", "search"):
+                    scope = current_display[1]
+                else:
+                    scope = None
+                try:
+                    terms, since, until = parse_search(user_input[7:])
+                except ValueError:
+                    print("Invalid date. Use from:YYYY-MM-DD and to:YYYY-MM-DD")
+                    time.sleep(1)
+                    continue
+                if not terms:
+                    print("Usage: /search <words or \"phrase\"> [from:YYYY-MM-DD] [to:YYYY-MM-DD]")
+                    time.sleep(1)
+                    continue
+                
+                last_search = (user_input[7:].strip(),
+                               current_bot.history_store.search(terms, chat_id=scope, since=since, until=until))
+                display_search_results(scope)
+                current_display = ("search", scope)
+                continue
+            
+            elif user_input.lower() == '/broadcast':
+                if not current_bot.active_chats:
+                    print("No active chats to broadcast to.")
+                    time.sleep(1)
+                    refresh_display()
+                    continue
+                
+                targets = input("Send to which chats? (all, or IDs separated by spaces): ").strip().lower()
+                if targets in ('', 'all'):
+                    chat_ids = list(current_bot.active_chats)
+                else:
+                    try:
+                        chat_ids = [int(chat_id) for chat_id in targets.replace(',', ' ').split()]
+                    except ValueError:
+                        print("Invalid chat ID list.")
+                        time.sleep(1)
+                        refresh_display()
+                        continue
+                    unknown = [chat_id for chat_id in chat_ids if chat_id not in current_bot.active_chats]
+                    if unknown:
+                        print(f"Unknown chat IDs: {', '.join(map(str, unknown))}")
+                        time.sleep(2)
+                        refresh_display()
+                        continue
+                
+                content = input("Message to broadcast (or /image, /document... to send a file): ").strip()
+                media = MEDIA_COMMANDS.get(content.lower())
+                kind = media.kind if media is not None else MessageType.TEXT
+                if media is not None:
+                    content = input(f"Enter the path to the {media.label.lower()}: ").strip()
+                    if not os.path.exists(content):
+                        print("File not found. Please check the path.")
+                        time.sleep(1)
+                        refresh_display()
+                        continue
+                if not content:
+                    refresh_display()
+                    continue
+                
+                confirm = input(f"Send to {len(chat_ids)} chats? (y/N): ").strip().lower()
+                if confirm != 'y':
+                    print("Broadcast cancelled.")
+                    time.sleep(1)
+                    refresh_display()
+                    continue
+                
+                results = broadcast(current_bot, chat_ids, content, kind=kind, progress=print_broadcast_progress)
+                failures = [(chat_id, error) for chat_id, (success, error) in results.items() if not success]
+                print(f"Sent to {len(results) - len(failures)} of {len(results)} chats.")
+                for chat_id, error in failures[:BROADCAST_FAILURES_SHOWN]:
+                    print(f"  {chat_id}: {error}")
+                if len(failures) > BROADCAST_FAILURES_SHOWN:
+                    print(f"  ...and {len(failures) - BROADCAST_FAILURES_SHOWN} more")
+                input("\nPress Enter to continue...")
+                refresh_display()
+                continue
+            
             # Handle settings changes
             elif current_display == "settings" and user_input.isdigit():
                 option = int(user_input)
@@ -823,7 +2643,7 @@ def console_interface(app: Application):
                         message_timer['image'] = max(0, timer)
                         print(f"Image timer set to {message_timer['image']} seconds")
                         time.sleep(1)
-                    except:
+                    except ValueError:
                         print("Invalid input")
                         time.sleep(1)
                     settings_interface()
@@ -833,7 +2653,7 @@ def console_interface(app: Application):
                         message_timer['text'] = max(0, timer)
                         print(f"Message timer set to {message_timer['text']} seconds")
                         time.sleep(1)
-                    except:
+                    except ValueError:
                         print("Invalid input")
                         time.sleep(1)
                     settings_interface()
@@ -847,6 +2667,16 @@ def console_interface(app: Application):
                     print(f"History saving {'enabled' if save_history else 'disabled'}")
                     time.sleep(1)
                     settings_interface()
+                elif option == 5:
+                    try:
+                        size = int(input("Enter messages to keep in memory per chat: "))
+                        live_window_size = max(PAGE_SIZE, size)
+                        print(f"Keeping {live_window_size} messages per chat in memory")
+                        time.sleep(1)
+                    except ValueError:
+                        print("Invalid input")
+                        time.sleep(1)
+                    settings_interface()
                 else:
                     print("Invalid option")
                     time.sleep(1)
@@ -856,19 +2686,18 @@ def console_interface(app: Application):
             # Handle chat deletion
             elif current_display == "delete" and user_input.isdigit():
                 chat_index = int(user_input)
-                chat_ids = list(active_chats.keys())
                 
-                if 1 <= chat_index <= len(chat_ids):
-                    chat_id_to_delete = chat_ids[chat_index - 1]
-                    chat_name = active_chats[chat_id_to_delete]['name']
+                if (1 <= chat_index <= len(delete_choices) and
+                        delete_choices[chat_index - 1] in current_bot.active_chats):
+                    chat_id_to_delete = delete_choices[chat_index - 1]
+                    chat_name = current_bot.active_chats[chat_id_to_delete]['name']
                     
                     # Confirmation
                     confirm = input(f"Are you sure you want to delete chat with {chat_name}? (y/N): ").strip().lower()
                     if confirm == 'y':
-                        del active_chats[chat_id_to_delete]
+                        current_bot.active_chats.remove_chat(chat_id_to_delete)
                         # Also delete from history if exists
-                        if chat_id_to_delete in chat_history:
-                            del chat_history[chat_id_to_delete]
+                        current_bot.history_store.delete_chat(chat_id_to_delete)
                         print(f"Chat with {chat_name} (ID: {chat_id_to_delete}) has been deleted.")
                         time.sleep(2)
                         
@@ -892,7 +2721,7 @@ def console_interface(app: Application):
                     # Delete all messages confirmation
                     confirm = input("Are you sure you want to delete ALL messages? (y/N): ").strip().lower()
                     if confirm == 'y':
-                        active_chats[chat_id]['messages'] = []
+                        current_bot.active_chats.clear_messages(chat_id)
                         print("All messages deleted.")
                         time.sleep(1)
                         display_chat_interface(chat_id)
@@ -903,15 +2732,13 @@ def console_interface(app: Application):
                         delete_message_interface(chat_id)
                 elif user_input.isdigit():
                     msg_index = int(user_input)
-                    messages = active_chats[chat_id]['messages']
                     
-                    if 1 <= msg_index <= len(messages):
-                        # Delete single message
-                        del messages[msg_index - 1]
+                    # Delete single message
+                    if current_bot.active_chats.pop_message(chat_id, position=msg_index - 1) is not None:
                         print(f"Message {msg_index} deleted.")
                         time.sleep(1)
                         
-                        if not messages:
+                        if not current_bot.active_chats[chat_id]['messages']:
                             display_chat_interface(chat_id)
                             current_display = chat_id
                         else:
@@ -934,6 +2761,16 @@ def console_interface(app: Application):
                 if user_input.lower() == '/back':
                     display_chat_interface(current_display[1])
                     current_display = current_display[1]
+                elif user_input.lower().startswith('/date'):
+                    # Jump to the page that starts with the first message of that day
+                    try:
+                        day = datetime.strptime(user_input[5:].strip(), "%Y-%m-%d")
+                        newer = current_bot.history_store.count_messages(current_display[1], since=day)
+                        view_offsets[current_display] = max(0, newer - PAGE_SIZE)
+                    except ValueError:
+                        print("Invalid date. Use /date YYYY-MM-DD")
+                        time.sleep(1)
+                    display_chat_history(current_display[1])
                 else:
                     print("Type /back to return to chat")
                     time.sleep(1)
@@ -941,9 +2778,10 @@ def console_interface(app: Application):
                 continue
                     
             # Check if we're in the main screen and input is a chat ID
-            elif current_display == "main" and user_input.isdigit():
+            elif (current_display == "main" or
+                  (isinstance(current_display, tuple) and current_display[0] == "find")) and user_input.isdigit():
                 chat_id = int(user_input)
-                if chat_id in active_chats:
+                if chat_id in current_bot.active_chats:
                     display_chat_interface(chat_id)
                     current_display = chat_id
                 else:
@@ -952,18 +2790,17 @@ def console_interface(app: Application):
                     display_main_interface()
                     
             # If we're in a chat conversation, handle message input
-            elif isinstance(current_display, int) and current_display in active_chats:
+            elif isinstance(current_display, int) and current_display in current_bot.active_chats:
                 chat_id = current_display
                 
                 if user_input.lower() == '/delete':
                     # Delete current chat with confirmation
-                    chat_name = active_chats[chat_id]['name']
+                    chat_name = current_bot.active_chats[chat_id]['name']
                     confirm = input(f"Are you sure you want to delete chat with {chat_name}? (y/N): ").strip().lower()
                     if confirm == 'y':
-                        del active_chats[chat_id]
+                        current_bot.active_chats.remove_chat(chat_id)
                         # Also delete from history if exists
-                        if chat_id in chat_history:
-                            del chat_history[chat_id]
+                        current_bot.history_store.delete_chat(chat_id)
                         print(f"Chat with {chat_name} has been deleted.")
                         time.sleep(2)
                         
@@ -984,52 +2821,46 @@ def console_interface(app: Application):
                     display_chat_history(chat_id)
                     current_display = ("history", chat_id)
                     
-                elif user_input.lower() == '/image':
-                    image_path = input("Enter the path to the image: ").strip()
+                elif user_input.lower() in MEDIA_COMMANDS:
+                    media = MEDIA_COMMANDS[user_input.lower()]
+                    file_path = input(f"Enter the path to the {media.label.lower()}: ").strip()
                     
-                    if not os.path.exists(image_path):
+                    if not os.path.exists(file_path):
                         print("File not found. Please check the path.")
                         time.sleep(1)
                         display_chat_interface(chat_id)
                         continue
-                        
+                    
                     # Ask if user wants to set a timer
-                    timer_choice = input("Set timer for this image? (y/N): ").strip().lower()
+                    timer_choice = input(f"Set timer for this {media.label.lower()}? (y/N): ").strip().lower()
                     timer_seconds = 0
                     
                     if timer_choice == 'y':
                         try:
                             timer_seconds = int(input("Enter timer in seconds: "))
                             timer_seconds = max(0, timer_seconds)
-                        except:
+                        except ValueError:
                             print("Invalid input, sending without timer")
                             timer_seconds = 0
                             time.sleep(1)
                     
-                    # Send image with timer
-                    success, message_id = send_message_with_timer(chat_id, image_path, is_image=True)
+                    # Send file with timer
+                    success, message_id = send_message_with_timer(current_bot, chat_id, file_path, kind=media.kind,
+                                                                  progress=print_upload_progress)
                     
                     if success:
-                        print("Photo sent!")
+                        print(f"{media.label} sent!")
                         
                         # Set timer for auto-delete if enabled
                         if timer_seconds > 0:
-                            print(f"Photo will be deleted in {timer_seconds} seconds...")
+                            print(f"{media.label} will be deleted in {timer_seconds} seconds...")
                             
-                            # Store message info for later deletion
-                            message_info = {
-                                'chat_id': chat_id,
-                                'message_id': message_id,
-                                'message_type': 'image',
-                                'delete_time': time.time() + timer_seconds,
-                                'filename': os.path.basename(image_path)
-                            }
-                            pending_deletions.append(message_info)
+                            schedule_deletion(current_bot, chat_id, message_id, timer_seconds)
                         
                         time.sleep(1)
                         display_chat_interface(chat_id)
                     else:
-                        print("Error sending photo.")
+                        print(f"Error sending {media.label.lower()}.")
                         time.sleep(2)
                         display_chat_interface(chat_id)
                         
@@ -1047,7 +2878,7 @@ def console_interface(app: Application):
                             
                         time.sleep(1)
                         display_chat_interface(chat_id)
-                    except:
+                    except ValueError:
                         print("Invalid input")
                         time.sleep(1)
                         display_chat_interface(chat_id)
@@ -1061,13 +2892,13 @@ def console_interface(app: Application):
                         try:
                             timer_seconds = int(input("Enter timer in seconds: "))
                             timer_seconds = max(0, timer_seconds)
-                        except:
+                        except ValueError:
                             print("Invalid input, sending without timer")
                             timer_seconds = 0
                             time.sleep(1)
                     
                     # Send text message with timer
-                    success, message_id = send_message_with_timer(chat_id, user_input)
+                    success, message_id = send_message_with_timer(current_bot, chat_id, user_input)
                     
                     if success:
                         print("Message sent!")
@@ -1076,15 +2907,7 @@ def console_interface(app: Application):
                         if timer_seconds > 0:
                             print(f"Message will be deleted in {timer_seconds} seconds...")
                             
-                            # Store message info for later deletion
-                            message_info = {
-                                'chat_id': chat_id,
-                                'message_id': message_id,
-                                'message_type': 'text',
-                                'delete_time': time.time() + timer_seconds,
-                                'text': user_input
-                            }
-                            pending_deletions.append(message_info)
+                            schedule_deletion(current_bot, chat_id, message_id, timer_seconds)
                         
                         time.sleep(0.5)
                         display_chat_interface(chat_id)
@@ -1095,70 +2918,544 @@ def console_interface(app: Application):
                         display_chat_interface(chat_id)
                 
         except Exception as e:
+            errors_logged.inc(source="console")
             print(f"Error: {e}")
             time.sleep(2)
-            if current_display == "main":
-                display_main_interface()
-            elif current_display == "ids":
-                display_ids_only()
-            elif current_display == "delete":
-                delete_chat_interface()
-            elif current_display == "settings":
-                settings_interface()
-            elif isinstance(current_display, tuple) and current_display[0] == "dmsg":
-                delete_message_interface(current_display[1])
-            elif isinstance(current_display, tuple) and current_display[0] == "history":
-                display_chat_history(current_display[1])
-            else:
-                display_chat_interface(current_display)
+            refresh_display()
 
-def main():
-    # Initialize bot
-    app = Application.builder().token(BOT_TOKEN).build()
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    app.add_handler(MessageHandler(filters.PHOTO, handle_message))
-    
-    print("Starting Telegram Messenger with Chat History...")
-    
-    # Create directory for downloaded images
-    os.makedirs("downloaded_images", exist_ok=True)
+async def shutdown_services():
+    """Stop the local servers and release the async connection pool when the bots shut down"""
+    if control_server is not None:
+        await control_server.close()
+    if metrics_server is not None:
+        await metrics_server.close()
+    await api_pool.aclose()
+
+class LocalHTTPServer:
+    """Minimal asyncio HTTP/1.1 server
+
+    Subclasses implement _dispatch(), which gets each request and returns
+    (status, payload); a str payload is sent back as plain text, anything
+    else as JSON. Connections are kept alive between requests.
+    """
+
+    STATUS_TEXT = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+                   405: "Method Not Allowed", 413: "Payload Too Large", 502: "Bad Gateway"}
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._server = None
+        self._writers = set()  # Open connections, closed on shutdown
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            # Idle keep-alive connections would otherwise hold wait_closed() open
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                
+                length = int(headers.get('content-length', 0))
+                if length > HTTP_MAX_BODY:
+                    status, payload = 413, None
+                else:
+                    status, payload = await self._dispatch(method, target, headers,
+                                                           await reader.readexactly(length))
+                
+                if isinstance(payload, str):
+                    body, content_type = payload.encode(), "text/plain; version=0.0.4; charset=utf-8"
+                else:
+                    body = json.dumps(payload).encode() if payload is not None else b""
+                    content_type = "application/json"
+                keep_alive = status != 413 and headers.get('connection', '').lower() != 'close'
+                writer.write(f"HTTP/1.1 {status} {self.STATUS_TEXT[status]}\r\n"
+                             f"Content-Type: {content_type}\r\n"
+                             f"Content-Length: {len(body)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+            pass  # Malformed request or the peer went away
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _dispatch(self, method, target, headers, body):
+        raise NotImplementedError
+
+class WebhookServer(LocalHTTPServer):
+    """Receives updates pushed by Telegram
+
+    routes maps each bot's webhook path to its Application. Every POST must
+    carry the secret in the X-Telegram-Bot-Api-Secret-Token header. Accepted
+    updates go straight onto the application's update queue, so they are
+    handled exactly like polled ones.
+    """
+
+    def __init__(self, routes, secret, host=WEBHOOK_HOST, port=WEBHOOK_PORT):
+        super().__init__(host, port)
+        self.routes = routes
+        self.secret = secret.encode()
+
+    async def _dispatch(self, method, target, headers, body):
+        """Queue the update in a request and return the HTTP status to answer with"""
+        app = self.routes.get(target.split('?', 1)[0])
+        if app is None:
+            return 404, None
+        if method != 'POST':
+            return 405, None
+        token = headers.get('x-telegram-bot-api-secret-token', '').encode()
+        if not hmac.compare_digest(token, self.secret):
+            return 403, None
+        try:
+            payload = json.loads(body)
+            if not isinstance(payload, dict):
+                return 400, None
+            update = Update.de_json(payload, app.bot)
+        except (ValueError, TypeError, KeyError):
+            return 400, None
+        await app.update_queue.put(update)
+        return 200, None
+
+def message_to_json(chat, msg):
+    """Return a message as a JSON-ready dict for the control API"""
+    return {
+        'message_id': msg.message_id,
+        'time': msg.time.isoformat(),
+        'direction': msg.direction.name.lower(),
+        'type': msg.kind.name.lower(),
+        'text': msg.text,
+        'filename': msg.filename,
+        'local_path': msg.local_path,
+        'seen': is_seen(chat, msg)
+    }
+
+class ControlServer(LocalHTTPServer):
+    """Local HTTP control API used instead of the console in headless mode
+
+    GET  /bots                        hosted bots
+    GET  /chats                       active chats
+    GET  /chats/<id>/messages?limit=N newest messages of a chat
+    POST /send                        {"chat_id", "text" or a file path, "timer_seconds"}
+    POST /broadcast                   {"chat_ids" (default all), "text" or a file path}
+    GET  /stats                       chat, deletion and queue counters
     
-    # Load existing chat history if available
-    global chat_history
+    A file is sent as "<command>_path" for its MediaType, e.g. "image_path"
+    or "document_path". Chats belong to the first bot unless a request names another, with
+    ?bot=<name> or a "bot" field. Replies follow the Bot API's shape:
+    {"ok": true, "result": ...} or {"ok": false, "description": ...}. There
+    is no authentication, so only bind it to a local interface.
+    """
+
+    async def _dispatch(self, method, target, headers, body):
+        url = urlsplit(target)
+        parts = [part for part in url.path.split('/') if part]
+        query = parse_qs(url.query)
+        try:
+            request = json.loads(body) if body else {}
+            if not isinstance(request, dict):
+                return self._error(400, "Invalid request: body must be a JSON object")
+            if parts == ['bots'] and method == 'GET':
+                return self._ok([{'name': name, 'chats': len(instance.active_chats), 'unread': instance.unread()}
+                                 for name, instance in bots.items()])
+            name = request.get('bot') or query.get('bot', [None])[0]
+            instance = bots.get(name) if name else next(iter(bots.values()))
+            if instance is None:
+                return self._error(404, "Unknown bot")
+            active_chats = instance.active_chats
+            if parts == ['chats'] and method == 'GET':
+                return self._ok([{'chat_id': chat_id, 'name': chat['name'], 'username': chat['username'],
+                                  'unread': chat['unread'], 'messages': len(chat['messages'])}
+                                 for chat_id, chat in active_chats.items()])
+            if len(parts) == 3 and parts[0] == 'chats' and parts[2] == 'messages' and method == 'GET':
+                chat = active_chats.get(int(parts[1]))
+                if chat is None:
+                    return self._error(404, "Unknown chat")
+                limit = int(query.get('limit', [PAGE_SIZE])[0])
+                _, page = active_chats.page(int(parts[1]), 0, limit)
+                return self._ok([message_to_json(chat, msg) for msg in page])
+            if parts == ['send'] and method == 'POST':
+                return await self._send(instance, request)
+            if parts == ['broadcast'] and method == 'POST':
+                return await self._broadcast(instance, request)
+            if parts == ['stats'] and method == 'GET':
+                return self._ok({'chats': len(active_chats),
+                                 'stored_chats': instance.history_store.chat_count(),
+                                 'pending_deletions': len(instance.deletion_scheduler),
+                                 'display_queue': get_queue_stats()})
+        except (ValueError, TypeError, KeyError) as e:
+            return self._error(400, f"Invalid request: {e}")
+        if parts and parts[0] in ('bots', 'chats', 'send', 'broadcast', 'stats'):
+            return self._error(405, "Method not allowed")
+        return self._error(404, "Not found")
+
+    @staticmethod
+    def _ok(result):
+        return 200, {'ok': True, 'result': result}
+
+    @staticmethod
+    def _error(status, description):
+        return status, {'ok': False, 'description': description}
+
+    @staticmethod
+    def _content(request):
+        """Return (text or file path, MessageType) from a send or broadcast request"""
+        for media in MEDIA_TYPES.values():
+            field = f"{media.command}_path"
+            if request.get(field):
+                if not os.path.exists(request[field]):
+                    raise ValueError(f"{field} does not exist")
+                return request[field], media.kind
+        if not request.get('text'):
+            raise ValueError("text or a file path (image_path, document_path...) is required")
+        return request['text'], MessageType.TEXT
+
+    async def _send(self, instance, request):
+        chat_id = int(request['chat_id'])
+        if chat_id not in instance.active_chats:
+            return self._error(404, "Unknown chat")
+        content, kind = self._content(request)
+        timer_seconds = max(0, int(request.get('timer_seconds', 0)))
+        
+        # Sending blocks on the network, so keep it off the event loop
+        loop = asyncio.get_running_loop()
+        success, result = await loop.run_in_executor(None, post_message, instance, chat_id, content, kind)
+        if not success:
+            return self._error(502, result)
+        if timer_seconds > 0:
+            schedule_deletion(instance, chat_id, result, timer_seconds)
+        return self._ok({'message_id': result})
+
+    async def _broadcast(self, instance, request):
+        chat_ids = [int(chat_id) for chat_id in request.get('chat_ids') or instance.active_chats]
+        unknown = [chat_id for chat_id in chat_ids if chat_id not in instance.active_chats]
+        if unknown:
+            return self._error(404, f"Unknown chats: {unknown}")
+        content, kind = self._content(request)
+        
+        loop = asyncio.get_running_loop()
+        results = await loop.run_in_executor(None, broadcast, instance, chat_ids, content, kind)
+        return self._ok({str(chat_id): {'ok': success, 'message_id' if success else 'description': result}
+                         for chat_id, (success, result) in results.items()})
+
+class MetricsServer(LocalHTTPServer):
+    """Serves render_metrics() at GET /metrics for Prometheus to scrape"""
+
+    async def _dispatch(self, method, target, headers, body):
+        if urlsplit(target).path != '/metrics':
+            return 404, None
+        if method != 'GET':
+            return 405, None
+        return 200, render_metrics()
+
+async def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Start the metrics endpoint, carrying on without it if the port is taken"""
+    global metrics_server
+    server = MetricsServer(host, port)
+    try:
+        await server.start()
+    except OSError as e:
+        print(f"Metrics endpoint disabled, could not listen on {host}:{port}: {e}")
+        return
+    metrics_server = server
+    print(f"Metrics available at http://{host}:{port}/metrics")
+
+async def start_local_servers(args):
+    """Start the metrics endpoint, and the control API when headless
+
+    With --workers the chats live in the worker processes, out of the
+    control API's reach, so it is not started.
+    """
+    if args.metrics_port:
+        await start_metrics_server(args.metrics_host, args.metrics_port)
+    if headless and not shard_queues:
+        await start_control_server(args.control_host, args.control_port)
+
+async def start_control_server(host=CONTROL_HOST, port=CONTROL_PORT):
+    """Start the headless control API on the bots' event loop"""
+    global control_server
+    control_server = ControlServer(host, port)
+    await control_server.start()
+    print(f"Control API listening on http://{host}:{port}")
+
+def webhook_path(instance):
+    """Return the path a bot's webhook updates are POSTed to"""
+    return WEBHOOK_PATH if len(bots) == 1 else f"{WEBHOOK_PATH}/{instance.name}"
+
+async def run_bots(args, secret=None):
+    """Run every bot on this event loop until interrupted
+
+    Each bot polls for its own updates, or with --webhook one local server
+    takes the updates of all of them, on a path per bot. With --webhook-url
+    set, Telegram is told to deliver them there; otherwise the webhooks are
+    assumed to be registered already (for example by the proxy's
+    deployment), and recorded updates can be POSTed to the server directly.
+    """
+    server = None
+    if args.webhook:
+        server = WebhookServer({webhook_path(instance): instance.app for instance in bots.values()},
+                               secret, args.host, args.port)
+    async with contextlib.AsyncExitStack() as stack:
+        # The same startup and shutdown steps as run_polling(), for every bot
+        for instance in bots.values():
+            await stack.enter_async_context(instance.app)
+        await start_local_servers(args)
+        for instance in bots.values():
+            if not args.webhook:
+                await instance.app.updater.start_polling()
+            await instance.app.start()
+        if server is not None:
+            await server.start()
+            for instance in bots.values():
+                if args.webhook_url:
+                    url = args.webhook_url.rstrip('/') + webhook_path(instance)[len(WEBHOOK_PATH):]
+                    await instance.app.bot.set_webhook(url, secret_token=secret,
+                                                       allowed_updates=Update.ALL_TYPES)
+                print(f"Listening for {instance.name} webhook updates on "
+                      f"http://{args.host}:{args.port}{webhook_path(instance)}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            if server is not None:
+                await server.close()
+            for instance in bots.values():
+                if instance.app.updater.running:
+                    await instance.app.updater.stop()
+                await instance.app.stop()
+            await shutdown_services()
+
+def build_application(instance, handler=handle_message):
+    """Build a bot's Application, sending its updates to handler"""
+    app = (Application.builder().token(instance.token)
+           .base_url(f"{API_BASE_URL}/bot").base_file_url(f"{API_BASE_URL}/file/bot")
+           .build())
+    app.bot_data['instance'] = instance  # How handlers find the bot an update is for
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handler))
+    for media in MEDIA_TYPES.values():
+        app.add_handler(MessageHandler(media.message_filter, handler))
+    return app
+
+def history_path(name):
+    """Return the history database of the named bot
+
+    Files are named after the bot, so reordering the tokens never hands one
+    bot another's history. DEFAULT_BOT, the bot of a lone BOT_TOKEN, keeps
+    HISTORY_DB, also after more bots are added beside it.
+    """
+    return HISTORY_DB if name == DEFAULT_BOT else f"chat_history_{name}.db"
+
+def load_bots(handler=handle_message, keep_history=True):
+    """Create a BotInstance for every configured token
+
+    Bots keeping history open their database, the one in HISTORY_DB
+    importing chat_history.pkl on first run, and resume their timed
+    deletions. The front process of --workers keeps none, passing updates
+    on to route_update.
+    """
+    for name, token in BOT_TOKENS.items():
+        path = history_path(name) if keep_history else None
+        # Workers find the databases already prepared by prepare_history()
+        import_legacy = path == HISTORY_DB and worker_shard is None
+        instance = BotInstance(name, token, path, import_legacy=import_legacy)
+        instance.app = build_application(instance, handler)
+        bots[name] = instance
+        if instance.history_store is None:
+            continue
+        where = "" if worker_shard is None else f" in shard {worker_shard[0]}"
+        print(f"Loaded chat history for {instance.history_store.chat_count()} chats of bot {name}{where}")
+        
+        # Start deletion processing thread, resuming timers from the last run
+        threading.Thread(target=process_deletions, args=(instance,), daemon=True).start()
+
+def prepare_history():
+    """Create or migrate every bot's database, importing chat_history.pkl, before workers share them"""
+    for name in BOT_TOKENS:
+        path = history_path(name)
+        HistoryStore(path, import_legacy=path == HISTORY_DB).close()
+
+def start_workers(count):
+    """Start count worker processes, each fed by its own queue in shard_queues"""
+    prepare_history()
+    # Spawned rather than forked: this process already runs threads
+    context = multiprocessing.get_context('spawn')
+    reports = context.Queue()
+    workers = []
+    for shard in range(count):
+        updates = context.Queue()
+        worker = context.Process(target=run_worker, args=(shard, count, updates, reports),
+                                 name=f"shard-{shard}")
+        worker.start()
+        shard_queues.append(updates)
+        workers.append(worker)
+    threading.Thread(target=collect_worker_metrics, args=(reports,), daemon=True).start()
+    print(f"Routing updates to {count} worker processes")
+    return workers
+
+def collect_worker_metrics(reports):
+    """Keep the latest metric snapshots the workers report, for render_metrics()"""
+    while True:
+        shard, snapshots = reports.get()
+        worker_metrics[shard] = snapshots
+
+def report_metrics(shard, reports):
+    """Send this worker's metric snapshots to the front process"""
+    reports.put((shard, {metric.name: metric.snapshot() for metric in metrics_registry}))
+
+def report_metrics_periodically(shard, reports):
+    """Report this worker's metrics every WORKER_METRICS_INTERVAL seconds"""
+    while True:
+        time.sleep(WORKER_METRICS_INTERVAL)
+        report_metrics(shard, reports)
+
+def stop_workers(workers):
+    """Let every worker finish the updates already routed to it, then exit"""
+    for updates in shard_queues:
+        updates.put(None)
+    for worker in workers:
+        worker.join(WORKER_STOP_TIMEOUT)
+        if worker.is_alive():
+            print(f"Worker {worker.name} did not stop in time, terminating it")
+            worker.terminate()
+
+def run_worker(shard, count, updates, reports):
+    """Worker process: handle the updates of one shard of chats for every bot
+
+    Telegram's global flood limit applies to the bot, not the process, so
+    each worker sends at its share of API_GLOBAL_RATE.
+    """
+    global headless, worker_shard, API_GLOBAL_RATE
+    # Ctrl+C reaches the whole process group; the front process decides when
+    # workers stop, once everything routed to them has been queued
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    headless = True
+    worker_shard = (shard, count)
+    API_GLOBAL_RATE /= count
+    load_bots()
+    threading.Thread(target=report_metrics_periodically, args=(shard, reports), daemon=True).start()
     try:
-        if os.path.exists("chat_history.pkl"):
-            with open("chat_history.pkl", "rb") as f:
-                chat_history = pickle.load(f)
-            print(f"Loaded chat history for {len(chat_history)} chats")
-    except:
-        print("Could not load chat history")
-        chat_history = {}
+        asyncio.run(serve_shard(updates))
+    finally:
+        # Commit any history writes still queued
+        for instance in bots.values():
+            instance.history_store.close()
+        report_metrics(shard, reports)
+
+async def serve_shard(updates):
+    """Feed routed updates to the bots' Applications until the front process stops"""
+    loop = asyncio.get_running_loop()
+    async with contextlib.AsyncExitStack() as stack:
+        for instance in bots.values():
+            await stack.enter_async_context(instance.app)
+            await instance.app.start()
+        try:
+            while True:
+                item = await loop.run_in_executor(None, updates.get)
+                if item is None:
+                    break
+                name, data = item
+                app = bots[name].app
+                # Applications handle their queue one update at a time, in order
+                await app.update_queue.put(Update.de_json(data, app.bot))
+        finally:
+            for instance in bots.values():
+                await instance.app.stop()  # Handles the updates already queued first
+    await api_pool.aclose()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Console messenger for one or more Telegram bots")
+    parser.add_argument('--webhook', action='store_true',
+                        help="receive updates on a local webhook server instead of polling")
+    parser.add_argument('--host', default=WEBHOOK_HOST, help="webhook server interface")
+    parser.add_argument('--port', type=int, default=WEBHOOK_PORT, help="webhook server port")
+    parser.add_argument('--webhook-url', help="public HTTPS URL to register with Telegram")
+    parser.add_argument('--secret', default=os.environ.get('WEBHOOK_SECRET'),
+                        help="webhook secret token (default: $WEBHOOK_SECRET, or a random one)")
+    parser.add_argument('--headless', action='store_true',
+                        help="run without the terminal UI, controlled through a local HTTP API "
+                             "(the default when stdin is not a terminal)")
+    parser.add_argument('--control-host', default=CONTROL_HOST, help="control API interface")
+    parser.add_argument('--control-port', type=int, default=CONTROL_PORT, help="control API port")
+    parser.add_argument('--metrics-host', default=METRICS_HOST, help="metrics endpoint interface")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help="metrics endpoint port, 0 to turn it off")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="handle updates in this many worker processes, sharded by chat "
+                             "(implies --headless, without the control API)")
+    return parser.parse_args()
+
+def main():
+    global current_bot, headless, screen
+    
+    args = parse_args()
+    headless = args.headless or args.workers > 1 or not sys.stdin.isatty()
     
-    # Start message processing thread
-    threading.Thread(target=process_message_queue, daemon=True).start()
+    print("Starting Telegram Messenger with Chat History...")
     
-    # Start seen status checking thread
-    threading.Thread(target=check_seen_status, daemon=True).start()
+    # Create directories for downloaded attachments
+    for directory in {media.directory for media in MEDIA_TYPES.values()}:
+        os.makedirs(directory, exist_ok=True)
     
-    # Start deletion processing thread
-    threading.Thread(target=process_deletions, daemon=True).start()
+    workers = []
+    if args.workers > 1:
+        # This process only receives updates; the workers keep the chats
+        workers = start_workers(args.workers)
+        load_bots(route_update, keep_history=False)
+    else:
+        load_bots()
+    current_bot = next(iter(bots.values()))
     
-    # Start console interface in a separate thread
-    threading.Thread(target=console_interface, args=(app,), daemon=True).start()
+    if headless:
+        print("Running headless, the terminal UI is disabled")
+    else:
+        # Route console output through the differential renderer
+        screen = ScreenRenderer(sys.stdout)
+        sys.stdout = screen
+        
+        # Start message processing thread
+        threading.Thread(target=process_message_queue, daemon=True).start()
+        
+        # Start console interface in a separate thread
+        threading.Thread(target=console_interface, daemon=True).start()
     
-    # Start the bot
+    # Start the bots
+    secret = None
+    if args.webhook:
+        secret = args.secret or uuid.uuid4().hex
+        if not args.secret:
+            print(f"Webhook secret token: {secret}")
     try:
-        app.run_polling()
+        asyncio.run(run_bots(args, secret))
     except KeyboardInterrupt:
-        # Save chat history before exiting
-        if save_history:
-            try:
-                with open("chat_history.pkl", "wb") as f:
-                    pickle.dump(chat_history, f)
-                print("Chat history saved successfully")
-            except Exception as e:
-                print(f"Error saving chat history: {e}")
         print("Goodbye!")
+    finally:
+        stop_workers(workers)
+        # Commit any history writes still queued
+        for instance in bots.values():
+            if instance.history_store is not None:
+                instance.history_store.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,125 @@
+"""Stress test for ChatStore: hammers one store from many threads at once
+
+Writers add messages, readers render pages, walk snapshots and query the
+recency and name indexes, and other threads delete messages, mark chats
+read and drop whole chats, all at the same time. Any exception in a thread, or a chat left in an inconsistent
+state, fails the run.
+
+    python stress_test.py --threads 32 --seconds 10
+"""
+import argparse
+import random
+import threading
+
+from main import ChatStore, Message, Direction, MessageType
+
+CHATS = 50  # Chat ids the threads fight over
+WINDOW = 200  # Messages kept per chat, small so trimming happens constantly
+
+def writer(store, stop, counters):
+    """Add incoming and outgoing messages to random chats"""
+    message_id = 0
+    while not stop.is_set():
+        chat_id = random.randrange(CHATS)
+        store.add_chat(chat_id, f"Chat {chat_id}", None)
+        message_id += 1
+        direction = random.choice((Direction.INCOMING, Direction.OUTGOING))
+        msg = Message(message_id * 1000 + threading.get_ident() % 1000, direction,
+                      MessageType.TEXT, text="stress")
+        store.add_message(chat_id, msg, WINDOW)
+        counters['added'] += 1
+
+def reader(store, stop, counters):
+    """Render pages and walk snapshots the way the screens do"""
+    while not stop.is_set():
+        for chat_id, chat in store.items():
+            try:
+                start, page = store.page(chat_id, random.randrange(WINDOW), 20)
+                store.mark_seen_upto(chat_id, random.randrange(1 << 30))
+            except KeyError:
+                continue  # Chat was removed after the snapshot was taken
+            assert start >= 0 and len(page) <= 20, (start, len(page))
+        assert len(store.recent(20)) <= 20
+        store.find(f"chat {random.randrange(CHATS)}")
+        counters['read'] += 1
+
+def remover(store, stop, counters):
+    """Delete messages, mark chats read and occasionally drop a whole chat"""
+    while not stop.is_set():
+        chat_id = random.randrange(CHATS)
+        action = random.random()
+        try:
+            if action < 0.6:
+                store.pop_message(chat_id, position=random.randrange(WINDOW))
+            elif action < 0.9:
+                store.mark_read(chat_id)
+            elif action < 0.98:
+                store.clear_messages(chat_id)
+            else:
+                store.remove_chat(chat_id)
+        except KeyError:
+            continue  # Chat does not exist right now
+        counters['removed'] += 1
+
+def run_thread(target, store, stop, counters, errors):
+    try:
+        target(store, stop, counters)
+    except Exception as e:
+        errors.append(f"{target.__name__}: {e!r}")
+        stop.set()
+
+def check(store):
+    """Return a list of invariant violations left in the store"""
+    problems = []
+    for chat_id, chat in store.items():
+        if len(chat['messages']) > WINDOW:
+            problems.append(f"chat {chat_id} holds {len(chat['messages'])} messages, limit is {WINDOW}")
+        if chat['unread'] < 0:
+            problems.append(f"chat {chat_id} has {chat['unread']} unread messages")
+    if len(store.recent()) != len(store):
+        problems.append(f"recency index holds {len(store.recent())} chats, store holds {len(store)}")
+    if len(store.find("chat")) != len(store):
+        problems.append(f"name index finds {len(store.find('chat'))} chats, store holds {len(store)}")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description="Hammer ChatStore from many threads")
+    parser.add_argument('--threads', type=int, default=24, help="threads of each kind are a third of this")
+    parser.add_argument('--seconds', type=float, default=5, help="how long to run")
+    args = parser.parse_args()
+
+    store = ChatStore()
+    stop = threading.Event()
+    errors = []
+    per_kind = max(1, args.threads // 3)
+    counters = {}
+    threads = []
+    for target in (writer, reader, remover):
+        for _ in range(per_kind):
+            thread_counters = {'added': 0, 'read': 0, 'removed': 0}
+            counters.setdefault(target.__name__, []).append(thread_counters)
+            threads.append(threading.Thread(target=run_thread,
+                                            args=(target, store, stop, thread_counters, errors)))
+
+    print(f"Running {len(threads)} threads for {args.seconds} seconds...")
+    for thread in threads:
+        thread.start()
+    stop.wait(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    totals = {key: sum(c[key] for kind in counters.values() for c in kind)
+              for key in ('added', 'read', 'removed')}
+    print(f"Messages added: {totals['added']}, snapshot passes: {totals['read']}, "
+          f"removals: {totals['removed']}")
+
+    problems = errors + check(store)
+    for problem in problems:
+        print(f"FAIL {problem}")
+    if problems:
+        raise SystemExit(1)
+    print("OK")
+
+if __name__ == "__main__":
+    main()